@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite for statistical_profiling. Generates synthetic robot data at several fleet sizes,
+runs baseline build, sample fetch, scoring and anomaly writing against the local data source and
+reports throughput (rows/s, robots/s) and peak memory for each stage.
+
+    python benchmark.py --robots 10 100 500 --json bench.json
+    python benchmark.py --robots 10 100 500 --compare bench.json
+
+With --compare the run fails (exit code 1) when a stage is slower than the saved run by more
+than --tolerance.
+
+@author: bmkea
+"""
+import argparse
+import json
+import logging
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+import data_sources
+from statistical_profiling import statistical_profiling
+
+
+def measure(stage):
+    '''
+    Run a stage twice, once for wall time and once under tracemalloc for peak memory.
+    Returns (result, seconds, peak_mb).
+    '''
+    start = time.perf_counter()
+    result = stage()
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    stage()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak / 1e6
+
+
+def run_fleet(robots, args):
+    #Fresh data directory per fleet size so tables don't carry over
+    with tempfile.TemporaryDirectory() as data_dir:
+        baseline_start = pd.Timestamp('2024-01-01 00:00:00')
+        baseline_end = baseline_start + pd.Timedelta(minutes=args.baseline_minutes)
+        sample_end = baseline_end + pd.Timedelta(minutes=args.sample_minutes)
+        raw = data_sources.synthetic_raw_data(robots=robots, minutes=args.baseline_minutes + args.sample_minutes,
+                                              samples_per_minute=args.samples_per_minute,
+                                              start_time=str(baseline_start), seed=args.seed)
+        raw.to_csv(data_dir + '/everything.csv', index=False)
+
+        #Program object pointed at the local data source, no cache or parallelism
+        profile = statistical_profiling()
+        profile.logger.setLevel(logging.WARNING)
+        profile.get_parameters()
+        profile.data_source = 'local'
+        profile.local_data_dir = data_dir
+        profile.baseline_cache = 'False'
+        profile.baseline_start_time, profile.baseline_end_time = str(baseline_start), str(baseline_end)
+        profile.sample_start_time, profile.sample_end_time = str(baseline_end), str(sample_end)
+        profile.anomaly_threshold = str(args.threshold)
+        profile.get_source().load_raw()
+
+        baseline_rows = robots * args.baseline_minutes * args.samples_per_minute
+        sample_rows = robots * args.sample_minutes * args.samples_per_minute
+
+        results = []
+        baseline, seconds, peak = measure(profile.set_baseline)
+        results.append(('baseline', baseline_rows, seconds, peak))
+        sample, seconds, peak = measure(lambda: profile.database_conn(query=3))
+        results.append(('fetch', sample_rows, seconds, peak))
+        baseline = profile.get_baseline()
+        anomalies, seconds, peak = measure(lambda: profile.score_anomalies(sample, baseline))
+        results.append(('score', len(sample), seconds, peak))
+        _, seconds, peak = measure(lambda: profile.database_conn(query=5, input_dataframe=anomalies))
+        results.append(('write', len(anomalies), seconds, peak))
+
+    return [{'robots': robots, 'stage': stage, 'rows': rows, 'seconds': seconds,
+             'rows_per_s': rows / seconds if seconds > 0 else float('inf'),
+             'robots_per_s': robots / seconds if seconds > 0 else float('inf'),
+             'peak_mb': peak} for stage, rows, seconds, peak in results]
+
+
+def compare(results, previous, tolerance):
+    #A stage regresses when its rows/s drops by more than tolerance against the saved run
+    saved = {(r['robots'], r['stage']): r for r in previous}
+    regressions = []
+    for r in results:
+        old = saved.get((r['robots'], r['stage']))
+        if old is not None and r['rows_per_s'] < old['rows_per_s'] * (1 - tolerance):
+            regressions.append('%s robots %s: %.0f rows/s (was %.0f)' % (r['robots'], r['stage'], r['rows_per_s'], old['rows_per_s']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark statistical_profiling stages on synthetic data')
+    parser.add_argument('--robots', type=int, nargs='+', default=[10, 100, 500])
+    parser.add_argument('--baseline-minutes', type=int, default=120)
+    parser.add_argument('--sample-minutes', type=int, default=30)
+    parser.add_argument('--samples-per-minute', type=int, default=60)
+    parser.add_argument('--threshold', type=float, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='save results to this file')
+    parser.add_argument('--compare', help='fail if slower than the results in this file')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = []
+    print('%8s %-9s %10s %9s %12s %11s %9s' % ('robots', 'stage', 'rows', 'seconds', 'rows/s', 'robots/s', 'peak MB'))
+    for robots in args.robots:
+        for r in run_fleet(robots, args):
+            results.append(r)
+            print('%8d %-9s %10d %9.3f %12.0f %11.1f %9.1f' % (r['robots'], r['stage'], r['rows'], r['seconds'],
+                                                                r['rows_per_s'], r['robots_per_s'], r['peak_mb']))
+
+    if args.json:
+        with open(args.json, 'w') as out:
+            json.dump(results, out, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r') as saved:
+            regressions = compare(results, json.load(saved), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
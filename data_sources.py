@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+"""
+Local data source for statistical_profiling. Replays raw robot data from a csv/parquet file and
+keeps the processed tables (baseline, moments, sketches, covariance, anomalies) as csv files in one
+directory, so the program can run and be benchmarked without the postgres servers.
+
+@author: bmkea
+"""
+import hashlib
+import os
+import time
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+from schema import AMP_LIST, JOINT_LIST
+
+#pandas aggregate for each agg_type (p95 is a quantile, see minute_maxima)
+AGG_FUNCTIONS = {'max': 'max', 'min': 'min', 'mean': 'mean'}
+
+#Timestamp columns of each stored table, parsed when a table is read back
+TABLE_DATES = {'stats_profile_baseline': ['start_time', 'end_time'],
+               'stats_profile_moments': ['start_time', 'end_time'],
+               'stats_profile_sketches': ['start_time', 'end_time'],
+               'stats_profile_covariance': ['start_time', 'end_time'],
+               'detected_anomalies': ['time_stamp']}
+
+
+class local_source():
+    '''
+    File backed stand-in for the postgres databases, same interface as
+    statistical_profiling.postgres_source (run, stream, prepare, version). run() takes the same
+    query numbers as statistical_profiling.database_conn and returns the same dataframes.
+    '''
+
+    def __init__(self, data_dir, metrics=None, raw_file='everything'):
+        self.data_dir = data_dir
+        self.metrics = metrics
+        self.raw_file = raw_file
+        self.raw = None
+        os.makedirs(data_dir, exist_ok=True)
+
+    def run(self, query, input_dataframe=False, params=None, key_columns=None):
+        #params are the same dict query_params builds for the SQL version
+        started = time.perf_counter()
+        query_results = self.execute(query, input_dataframe, params, key_columns)
+        if self.metrics is not None:
+            self.metrics.observe('local_query', started, rows=None if query_results is None else len(query_results))
+        return query_results
+
+    def execute(self, query, input_dataframe, params, key_columns):
+        if query == 1:
+            return self.baseline_stats(params['baseline_start_time'], params['baseline_end_time'], params.get('agg_type', 'max'))
+        elif query == 2:
+            self.write_table('stats_profile_baseline', input_dataframe)
+        elif query == 3:
+            return self.minute_maxima(params['sample_start_time'], params['sample_end_time'], params.get('robot_names'),
+                                      agg_type=params.get('agg_type', 'max'))
+        elif query == 4:
+            return self.read_table('stats_profile_baseline')
+        elif query == 5:
+            self.append_table('detected_anomalies', input_dataframe, key_columns)
+        elif query == 6:
+            return self.read_table('stats_profile_moments')
+        elif query == 7:
+            moments_dataframe, baseline_dataframe = input_dataframe
+            self.write_table('stats_profile_moments', moments_dataframe)
+            self.write_table('stats_profile_baseline', baseline_dataframe)
+        elif query == 10:
+            self.write_table('stats_profile_sketches', input_dataframe)
+        elif query == 11:
+            return self.read_table('stats_profile_sketches')
+        elif query == 12:
+            self.write_table('stats_profile_covariance', input_dataframe)
+        elif query == 13:
+            return self.read_table('stats_profile_covariance')
+        elif query == 9:
+            self.replace_range('detected_anomalies', input_dataframe, 'time_stamp', params['start_time'], params['end_time'])
+        else:
+            raise ValueError('Unknown query %s' % query)
+
+    def prepare(self, query, time_range=None):
+        #Nothing to roll up, minutes are aggregated from the raw file on every read
+        pass
+
+    def stream(self, query, params, fetch_size):
+        #Chunked version of run() for queries 1, 3 and 4
+        result = self.run(query, params=params)
+        for start in range(0, len(result), fetch_size):
+            yield result.iloc[start:start + fetch_size].reset_index(drop=True)
+
+    def version(self):
+        #md5 of the stored baseline file, same role as the md5 of the postgres table
+        path = self.table_path('stats_profile_baseline')
+        if not os.path.exists(path):
+            return ''
+        with open(path, 'rb') as table_file:
+            return hashlib.md5(table_file.read()).hexdigest()
+
+    def load_raw(self):
+        #Raw data is read once and kept in memory for replay
+        if self.raw is None:
+            path = os.path.join(self.data_dir, self.raw_file)
+            if os.path.exists(path + '.parquet'):
+                raw = pd.read_parquet(path + '.parquet')
+            else:
+                raw = pd.read_csv(path + '.csv', parse_dates=['Time_Stamp'])
+            self.raw = raw.sort_values('Time_Stamp', kind='mergesort').reset_index(drop=True)
+        return self.raw
+
+    def minute_maxima(self, start_time, end_time, robot_names=None, include_start=True, agg_type='max'):
+        '''
+        Same result as query 3: agg_type (max, min, mean, p95) of each amp per robot and minute,
+        rounded to 5 places. Columns keep the max_amp_n names either way.
+        '''
+        raw = self.load_raw()
+        times = raw['Time_Stamp'].to_numpy()
+        lower = np.searchsorted(times, np.datetime64(pd.Timestamp(start_time)), side='left' if include_start else 'right')
+        upper = np.searchsorted(times, np.datetime64(pd.Timestamp(end_time)), side='left')
+        window = raw.iloc[lower:upper]
+        if robot_names is not None:
+            window = window[window['Robot_Name'].isin(list(robot_names))]
+
+        grouped = window.groupby([window['Time_Stamp'].dt.floor('min').rename('time_by_minute'), 'Robot_Name'], sort=True)[AMP_LIST]
+        if agg_type == 'p95':
+            minutes = grouped.quantile(0.95)
+        else:
+            minutes = grouped.agg(AGG_FUNCTIONS[agg_type])
+        minutes = minutes.round(5).reset_index()
+        minutes.columns = ['time_by_minute', 'Robot_Name'] + JOINT_LIST
+        return minutes
+
+    def baseline_stats(self, start_time, end_time, agg_type='max'):
+        '''
+        Same result as query 1: mean and sample std of the minute aggregates per robot.
+        '''
+        minutes = self.minute_maxima(start_time, end_time, include_start=False, agg_type=agg_type)
+        grouped = minutes.groupby('Robot_Name', sort=True)
+        baseline = grouped['time_by_minute'].agg(start_time='min', end_time='max')
+        for i, joint in enumerate(JOINT_LIST, start=1):
+            baseline['mean_of_max_amp_%02d' % i] = grouped[joint].mean().round(5)
+            baseline['std_of_max_amp_%02d' % i] = grouped[joint].std().round(5)
+        return baseline.reset_index()
+
+    def table_path(self, table):
+        return os.path.join(self.data_dir, table + '.csv')
+
+    def read_table(self, table):
+        path = self.table_path(table)
+        if not os.path.exists(path):
+            return pd.DataFrame()
+        dates = [c for c in TABLE_DATES.get(table, []) if c in pd.read_csv(path, nrows=0).columns]
+        return pd.read_csv(path, parse_dates=dates)
+
+    def write_table(self, table, dataframe):
+        #Column names are lower cased the way postgres folds unquoted names
+        dataframe = dataframe.rename(columns=str.lower)
+        dataframe.to_csv(self.table_path(table) + '.tmp', index=False)
+        os.replace(self.table_path(table) + '.tmp', self.table_path(table))
+
+    @contextmanager
+    def table_lock(self, table, timeout=60):
+        '''
+        Lock file around read-modify-write of a table, so worker processes (parallel, backfill)
+        don't overwrite each other. O_EXCL create works the same on windows and linux.
+        '''
+        path = self.table_path(table) + '.lock'
+        deadline = time.time() + timeout
+        while(True):
+            try:
+                handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                if time.time() > deadline:
+                    raise TimeoutError('Could not lock %s' % path)
+                time.sleep(0.01)
+        try:
+            yield
+        finally:
+            os.close(handle)
+            os.remove(path)
+
+    def replace_range(self, table, dataframe, time_column, start_time, end_time):
+        #Drop the rows of [start_time, end_time) and write the new ones in their place
+        with self.table_lock(table):
+            existing = self.read_table(table)
+            if len(existing) > 0:
+                times = existing[time_column]
+                existing = existing[(times < pd.Timestamp(start_time)) | (times >= pd.Timestamp(end_time))]
+            self.write_table(table, pd.concat([existing, dataframe.rename(columns=str.lower)], ignore_index=True))
+
+    def append_table(self, table, dataframe, key_columns=None):
+        #With key_columns, existing rows with the same keys are replaced (upsert)
+        dataframe = dataframe.rename(columns=str.lower)
+        with self.table_lock(table):
+            if key_columns is not None:
+                existing = self.read_table(table)
+                if len(existing) > 0:
+                    keys = pd.MultiIndex.from_frame(dataframe[key_columns])
+                    existing = existing[~pd.MultiIndex.from_frame(existing[key_columns]).isin(keys)]
+                self.write_table(table, pd.concat([existing, dataframe], ignore_index=True))
+            else:
+                path = self.table_path(table)
+                dataframe.to_csv(path, mode='a', index=False, header=not os.path.exists(path))
+
+
+def synthetic_raw_data(robots=10, minutes=60, samples_per_minute=60, start_time='2024-01-01 00:00:00',
+                       anomaly_rate=0.001, seed=0):
+    '''
+    Generate raw robot amperage data in the public.everything layout (Time_Stamp, Robot_Name,
+    Amp_1..Amp_6). Every robot/joint gets its own level and noise, and a small share of
+    samples get a spike so scoring has anomalies to find.
+    '''
+    rng = np.random.default_rng(seed)
+    samples = minutes * samples_per_minute
+    step = pd.Timedelta(minutes=1) / samples_per_minute
+    times = pd.date_range(start_time, periods=samples, freq=step)
+
+    levels = rng.uniform(2, 20, size=(robots, 1, 6))
+    noise = rng.uniform(0.05, 0.5, size=(robots, 1, 6))
+    amps = levels + noise * rng.standard_normal((robots, samples, 6))
+    spikes = rng.random((robots, samples, 6)) < anomaly_rate
+    amps[spikes] += levels.repeat(samples, axis=1)[spikes] * rng.uniform(0.5, 1.5, size=spikes.sum())
+
+    #Rows are ordered by time, then robot, like the sensor feed
+    amps = amps.transpose(1, 0, 2).reshape(samples * robots, 6)
+    raw = pd.DataFrame(amps, columns=AMP_LIST)
+    raw.insert(0, 'Robot_Name', np.tile(np.array(['Robot_%04d' % r for r in range(robots)], dtype=object), samples))
+    raw.insert(0, 'Time_Stamp', np.repeat(times.to_numpy(), robots))
+    return raw
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing and counters for statistical_profiling, exported in the Prometheus text format
+either as a file (for the node_exporter textfile collector) or from a small local HTTP endpoint.
+
+@author: bmkea
+"""
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class stage_metrics():
+    '''
+    Collects seconds, calls and rows per stage (connect, query, fetch, dataframe, score, write,
+    cycle...) plus plain counters (retries, anomalies). Safe to update from several threads.
+    '''
+
+    def __init__(self, prefix='stats_profile'):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.server = None
+
+    def observe(self, stage, started, rows=None):
+        '''
+        Record the time since started (a time.perf_counter() value) against stage and return
+        the current perf_counter, so consecutive stages can be chained.
+        '''
+        now = time.perf_counter()
+        with self.lock:
+            seconds, calls, total_rows, _ = self.stages.get(stage, (0.0, 0, 0, 0.0))
+            self.stages[stage] = (seconds + now - started, calls + 1, total_rows + (rows or 0), now - started)
+        return now
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def render(self):
+        #Prometheus text exposition format
+        with self.lock:
+            stages = dict(self.stages)
+            counters = dict(self.counters)
+        lines = []
+        for name, index, kind, help_text in (('stage_seconds_total', 0, 'counter', 'Time spent per stage'),
+                                             ('stage_calls_total', 1, 'counter', 'Calls per stage'),
+                                             ('stage_rows_total', 2, 'counter', 'Rows handled per stage'),
+                                             ('stage_last_seconds', 3, 'gauge', 'Duration of the last call per stage')):
+            lines.append('# HELP %s_%s %s' % (self.prefix, name, help_text))
+            lines.append('# TYPE %s_%s %s' % (self.prefix, name, kind))
+            for stage in sorted(stages):
+                lines.append('%s_%s{stage="%s"} %s' % (self.prefix, name, stage, stages[stage][index]))
+        for counter in sorted(counters):
+            lines.append('# TYPE %s_%s_total counter' % (self.prefix, counter))
+            lines.append('%s_%s_total %s' % (self.prefix, counter, counters[counter]))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path):
+        #Temp file then rename so a scraper never reads a half written file
+        with open(path + '.tmp', 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.replace(path + '.tmp', path)
+
+    def serve(self, port, host='127.0.0.1'):
+        '''
+        Serve /metrics on a background thread. Only started once per object.
+        '''
+        if self.server is not None:
+            return
+        metrics = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                #Scrapes are not logged
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), handler)
+        threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True).start()
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time ingestion for statistical_profiling. Subscribes to robot amperage messages on the MQTT
+broker from config.txt, keeps per robot/minute buckets in memory, closes each bucket once the
+event-time watermark has passed it, scores closed minutes against the cached baseline and
+publishes and/or batch-writes the anomalies. local_broker is an in-process stand-in for the
+broker so the path can be run without one.
+
+Messages are JSON in the public.everything layout:
+    {"Time_Stamp": "2024-02-22 12:20:01.250", "Robot_Name": "Robot_01", "Amp_1": 3.2, ... "Amp_6": 1.1}
+
+@author: bmkea
+"""
+import json
+import threading
+import time
+import numpy as np
+import pandas as pd
+from schema import AMP_LIST, JOINT_LIST
+
+#paho-mqtt is only needed for a real broker
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
+
+
+class minute_aggregator():
+    '''
+    Per robot, per minute aggregate of the six amps for agg_type (max, min, mean, p95). A bucket
+    is closed once the watermark (latest event time seen minus lateness) is past the end of its
+    minute. Samples for a minute that is already closed are dropped and counted.
+    '''
+
+    def __init__(self, agg_type='max', lateness=5.0):
+        self.agg_type = agg_type
+        self.lateness = pd.Timedelta(seconds=lateness)
+        self.buckets = {}
+        self.latest = None
+        self.latest_arrival = None
+        self.closed_before = None
+        self.late_samples = 0
+
+    def add(self, time_stamp, robot_name, amps):
+        minute = time_stamp.floor('min')
+        if self.closed_before is not None and minute < self.closed_before:
+            self.late_samples += 1
+            return False
+        amps = np.asarray(amps, dtype=np.float64)
+        bucket = self.buckets.get((robot_name, minute))
+        if bucket is None:
+            bucket = self.buckets[(robot_name, minute)] = self.new_bucket(amps)
+        else:
+            self.update_bucket(bucket, amps)
+        if self.latest is None or time_stamp > self.latest:
+            self.latest = time_stamp
+            self.latest_arrival = time.time()
+        return True
+
+    def new_bucket(self, amps):
+        if self.agg_type == 'mean':
+            return [amps.copy(), 1]
+        elif self.agg_type == 'p95':
+            return [amps]
+        return amps.copy()
+
+    def update_bucket(self, bucket, amps):
+        if self.agg_type == 'max':
+            np.maximum(bucket, amps, out=bucket)
+        elif self.agg_type == 'min':
+            np.minimum(bucket, amps, out=bucket)
+        elif self.agg_type == 'mean':
+            bucket[0] += amps
+            bucket[1] += 1
+        else:
+            bucket.append(amps)
+
+    def bucket_value(self, bucket):
+        if self.agg_type == 'mean':
+            return bucket[0] / bucket[1]
+        elif self.agg_type == 'p95':
+            return np.quantile(np.vstack(bucket), 0.95, axis=0)
+        return bucket
+
+    def close(self, now=None):
+        '''
+        Close every bucket whose minute ended before the watermark. With now (wall clock seconds,
+        time.time()) the watermark also moves on by the time elapsed since the latest sample
+        arrived, so the last minute is closed when the robots go quiet. The wall clock itself is
+        never compared to event time, robot clocks may be behind or in another time zone.
+        Returns the closed minutes in the query 3 layout.
+        '''
+        watermark = self.latest
+        if watermark is not None and now is not None:
+            watermark = watermark + pd.Timedelta(seconds=max(now - self.latest_arrival, 0))
+        if watermark is None:
+            return pd.DataFrame(columns=['time_by_minute', 'Robot_Name'] + JOINT_LIST)
+        closed_before = (watermark - self.lateness).floor('min')
+        if self.closed_before is None or closed_before > self.closed_before:
+            self.closed_before = closed_before
+
+        keys = sorted((k for k in self.buckets if k[1] < self.closed_before), key=lambda k: (k[1], k[0]))
+        rows = [self.bucket_value(self.buckets.pop(k)) for k in keys]
+        minutes = pd.DataFrame(np.round(np.vstack(rows), 5) if rows else np.empty((0, 6)), columns=JOINT_LIST)
+        minutes.insert(0, 'Robot_Name', [k[0] for k in keys])
+        minutes.insert(0, 'time_by_minute', pd.to_datetime([k[1] for k in keys]))
+        return minutes
+
+
+class local_broker():
+    '''
+    In-process stand-in for an MQTT broker and client with the part of the paho Client
+    interface mqtt_ingest uses. publish() hands the message straight to matching subscribers.
+    '''
+
+    class message():
+        def __init__(self, topic, payload):
+            self.topic = topic
+            self.payload = payload
+
+    def __init__(self):
+        self.on_message = None
+        self.subscriptions = []
+        self.published = []
+
+    def connect(self, host=None, port=None, keepalive=60):
+        return 0
+
+    def subscribe(self, topic, qos=0):
+        self.subscriptions.append(topic)
+
+    def publish(self, topic, payload=None, qos=0):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        self.published.append((topic, payload))
+        if self.on_message is not None and any(topic_matches(s, topic) for s in self.subscriptions):
+            self.on_message(self, None, local_broker.message(topic, payload))
+
+    def loop_start(self):
+        pass
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+
+def topic_matches(subscription, topic):
+    #MQTT wildcard match, + is one level and # is the rest
+    sub_levels, topic_levels = subscription.split('/'), topic.split('/')
+    for i, level in enumerate(sub_levels):
+        if level == '#':
+            return True
+        if i >= len(topic_levels) or (level != '+' and level != topic_levels[i]):
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class mqtt_ingest():
+    '''
+    Wires a broker client to a statistical_profiling object. Messages are aggregated on the
+    client's network thread, closed minutes are scored and sent out from run()/step(). The
+    table baseline is kept in memory and re-read every baseline_cache_ttl seconds.
+    '''
+
+    def __init__(self, profile, client=None):
+        self.profile = profile
+        self.aggregator = minute_aggregator(profile.agg_type, profile.mqtt_lateness)
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_rows = 0
+        self.last_write = time.time()
+        self.bad_messages = 0
+        self.unscored = None
+        self.baseline = None
+        self.baseline_read = 0
+
+        if client is None:
+            if mqtt is None:
+                raise ImportError('run_mode = mqtt needs the paho-mqtt package (pip install paho-mqtt)')
+            try:
+                client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            except AttributeError:
+                client = mqtt.Client()
+        self.client = client
+        self.client.on_message = self.on_message
+
+    def start(self):
+        #Anomalies published inside the subscription would come back in as samples
+        if self.profile.mqtt_anomaly_topic and topic_matches(self.profile.mqtt_topic, self.profile.mqtt_anomaly_topic):
+            raise ValueError('mqtt_anomaly_topic %s is inside mqtt_topic %s' % (self.profile.mqtt_anomaly_topic, self.profile.mqtt_topic))
+        self.client.connect(self.profile.broker, int(self.profile.port))
+        self.client.subscribe(self.profile.mqtt_topic)
+        self.client.loop_start()
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+        self.flush(force=True)
+        if self.pending:
+            self.profile.logger.error('Stopping with %s anomalies not written' % self.pending_rows)
+
+    def on_message(self, client, userdata, message):
+        try:
+            sample = json.loads(message.payload)
+            time_stamp = pd.Timestamp(sample['Time_Stamp'])
+            amps = [sample[a] for a in AMP_LIST]
+            robot_name = sample['Robot_Name']
+        except (ValueError, KeyError, TypeError):
+            self.bad_messages += 1
+            return
+        with self.lock:
+            if not self.aggregator.add(time_stamp, robot_name, amps):
+                self.profile.metrics.count('late_samples')
+
+    def scoring_baseline(self):
+        #Rolling/EWMA baselines are in memory already, the table is only re-read once the ttl is up
+        if self.profile.baseline_source != 'table':
+            return self.profile.scoring_baseline()
+        if self.baseline is None or time.time() - self.baseline_read >= self.profile.baseline_cache_ttl:
+            try:
+                self.baseline = self.profile.scoring_baseline()
+                self.baseline_read = time.time()
+            except Exception as error:
+                if self.baseline is None:
+                    raise
+                self.profile.logger.warning('Could not refresh the baseline, using the one in memory: %s – %s'
+                                            % (type(error).__name__, error))
+        return self.baseline
+    
+    def step(self, now=None):
+        '''
+        Close finished minutes, score them against the cached baseline, publish anomalies and
+        queue them for the batched database write. Minutes that could not be scored (baseline
+        not readable) are kept and scored with the next step. Returns the anomalies of this step.
+        '''
+        with self.lock:
+            minutes = self.aggregator.close(now)
+        if self.unscored is not None:
+            minutes = pd.concat([self.unscored, minutes], ignore_index=True)
+            self.unscored = None
+        if len(minutes) == 0:
+            self.flush()
+            return minutes
+        try:
+            anomalies = self.profile.score_anomalies(minutes, self.scoring_baseline())
+        except Exception as error:
+            self.profile.logger.error('Scoring %s minutes failed, keeping them for the next step: %s – %s'
+                                      % (len(minutes), type(error).__name__, error))
+            self.profile.metrics.count('failed_scoring')
+            self.unscored = minutes
+            self.flush()
+            return minutes.iloc[:0]
+        self.profile.metrics.count('mqtt_minutes', len(minutes))
+        
+        #The window store skips minutes it already has, a failed save is retried with the next minutes
+        try:
+            self.profile.observe_minutes(minutes)
+        except Exception as error:
+            self.profile.logger.error('Updating the window store failed: %s – %s' % (type(error).__name__, error))
+
+        if len(anomalies) > 0 and self.profile.mqtt_anomaly_topic:
+            for row in anomalies.itertuples(index=False):
+                self.client.publish(self.profile.mqtt_anomaly_topic, json.dumps(
+                    {'robot_name': row.robot_name, 'joint': row.joint, 'time_stamp': str(row.time_stamp),
+                     'zscore': float(row.zscore), 'actual_value': float(row.actual_value)}))
+        if len(anomalies) > 0 and self.profile.mqtt_write == 'True':
+            self.pending.append(anomalies)
+            self.pending_rows += len(anomalies)
+        self.flush()
+        return anomalies
+
+    def flush(self, force=False):
+        #Batch write every mqtt_write_interval seconds or mqtt_write_batch rows
+        if not self.pending:
+            return
+        if force or self.pending_rows >= self.profile.mqtt_write_batch or time.time() - self.last_write >= self.profile.mqtt_write_interval:
+            batch = pd.concat(self.pending, ignore_index=True)
+            try:
+                self.profile.database_conn(query=5, input_dataframe=batch)
+            except Exception as error:
+                #database_conn gave up retrying, keep the batch and try again on the next step
+                self.profile.logger.error('Writing %s anomalies failed, keeping them for the next step: %s – %s'
+                                          % (len(batch), type(error).__name__, error))
+                self.profile.metrics.count('failed_writes')
+                self.pending, self.pending_rows = [batch], len(batch)
+                return
+            self.pending, self.pending_rows = [], 0
+            self.last_write = time.time()
+
+    def run(self):
+        #Main loop, passes the wall clock so minutes still close when the robots go quiet
+        self.start()
+        try:
+            while(True):
+                self.step(now=time.time())
+                time.sleep(1)
+        except KeyboardInterrupt:
+            self.profile.logger.info('Stopping mqtt ingestion...')
+        finally:
+            self.stop()
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches for robust baselines. Each robot/joint gets a small t-digest (merging
+variant): a sorted list of centroids (mean, weight) compressed with the arcsine scale function, so
+the tails stay accurate and the size is bounded by the compression (about compression / 2
+centroids, under 2 kB at the default of 100).
+Sketches from different days or worker processes merge by concatenating and re-compressing, which
+makes baseline building parallel and incremental. Stored sketches are kept per partition of the
+baseline window so whole partitions can be dropped when the window moves on.
+
+@author: bmkea
+"""
+import numpy as np
+import pandas as pd
+from schema import JOINT_LIST, MEAN_LIST, STD_LIST
+
+SKETCH_COLUMNS = ['robot_name', 'joint', 'n', 'min_value', 'max_value', 'centroids', 'start_time', 'end_time']
+
+#Scale factor that turns the MAD of a normal distribution into its standard deviation
+MAD_SCALE = 1.4826
+
+
+class quantile_sketch():
+    '''
+    Merging t-digest. add() and merge() re-compress so every centroid spans at most one unit of
+    the scale function k(q) = compression / (2 pi) * asin(2q - 1).
+    '''
+
+    def __init__(self, compression=100, means=None, weights=None, min_value=np.inf, max_value=-np.inf):
+        self.compression = compression
+        self.means = np.empty(0) if means is None else np.asarray(means, dtype=np.float64)
+        self.weights = np.empty(0) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.min_value = min_value
+        self.max_value = max_value
+
+    @property
+    def n(self):
+        return float(self.weights.sum())
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            return self
+        self.min_value = min(self.min_value, values.min())
+        self.max_value = max(self.max_value, values.max())
+        self.compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+        return self
+
+    def merge(self, other):
+        self.min_value = min(self.min_value, other.min_value)
+        self.max_value = max(self.max_value, other.max_value)
+        self.compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        return self
+
+    def compress(self, means, weights):
+        #Vectorized: sort, then group points whose left quantile falls in the same unit of k(q)
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+        if total == 0:
+            self.means, self.weights = means, weights
+            return
+        q_left = (np.cumsum(weights) - weights) / total
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q_left - 1))
+        starts = np.concatenate([[0], np.nonzero(np.diff(k))[0] + 1])
+        group_weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / group_weights
+        self.weights = group_weights
+
+    def quantile(self, q):
+        '''
+        Value at quantile q (scalar or array), interpolated between centroid centres and clamped
+        to the exact min/max.
+        '''
+        if len(self.means) == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        total = self.weights.sum()
+        centres = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0], centres, [total]])
+        values = np.concatenate([[self.min_value], self.means, [self.max_value]])
+        return np.interp(np.asarray(q) * total, positions, values)
+
+    def cdf(self, x):
+        #Inverse of quantile(), share of the weight at or below x
+        if len(self.means) == 0:
+            return np.full(np.shape(x), np.nan) if np.ndim(x) else np.nan
+        total = self.weights.sum()
+        centres = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0], centres, [total]])
+        values = np.concatenate([[self.min_value], self.means, [self.max_value]])
+        return np.interp(x, values, positions) / total
+
+    def mad(self, iterations=60):
+        '''
+        Median absolute deviation: the m with cdf(median + m) - cdf(median - m) = 0.5, found by
+        bisection on the interpolated cdf.
+        '''
+        if len(self.means) == 0:
+            return np.nan
+        median = self.quantile(0.5)
+        low, high = 0.0, self.max_value - self.min_value
+        for _ in range(iterations):
+            m = (low + high) / 2
+            if self.cdf(median + m) - self.cdf(median - m) < 0.5:
+                low = m
+            else:
+                high = m
+        return (low + high) / 2
+
+    def to_hex(self):
+        #Centroids as postgres bytea hex text (float64 means then weights)
+        return '\\x' + np.concatenate([self.means, self.weights]).astype('<f8').tobytes().hex()
+
+    @classmethod
+    def from_stored(cls, centroids, min_value, max_value, compression=100):
+        #Accepts the hex text written by to_hex or the bytes/memoryview psycopg2 returns for bytea
+        if isinstance(centroids, str):
+            centroids = bytes.fromhex(centroids[2:] if centroids.startswith('\\x') else centroids)
+        values = np.frombuffer(bytes(centroids), dtype='<f8')
+        half = len(values) // 2
+        return cls(compression, values[:half].copy(), values[half:].copy(), float(min_value), float(max_value))
+
+
+def build_sketches(minute_dataframe, compression=100):
+    '''
+    Sketch per (robot, joint) from minute values in the query 3 layout.
+    '''
+    sketches = {}
+    for robot_name, robot_minutes in minute_dataframe.groupby('Robot_Name', sort=True):
+        for joint in JOINT_LIST:
+            sketches[(robot_name, joint)] = quantile_sketch(compression).add(robot_minutes[joint].to_numpy(dtype=np.float64))
+    return sketches
+
+
+def merge_sketches(a, b):
+    #Merge two sketch maps (sketches of a are merged in place), robots/joints in only one are kept as is
+    merged = dict(a)
+    for key, sketch in b.items():
+        merged[key] = merged[key].merge(sketch) if key in merged else sketch
+    return merged
+
+
+def sketches_to_frame(sketches, start_time, end_time):
+    #Rows for stats_profile_sketches
+    rows = [[robot_name, joint, s.n, s.min_value, s.max_value, s.to_hex(), start_time, end_time]
+            for (robot_name, joint), s in sorted(sketches.items())]
+    return pd.DataFrame(rows, columns=SKETCH_COLUMNS)
+
+
+def frame_to_sketches(dataframe, compression=100):
+    #Rows of several partitions for the same robot/joint are merged, in partition order
+    sketches = {}
+    for row in dataframe.sort_values('start_time', kind='mergesort').itertuples(index=False):
+        sketch = quantile_sketch.from_stored(row.centroids, row.min_value, row.max_value, compression)
+        key = (row.robot_name, row.joint)
+        sketches[key] = sketches[key].merge(sketch) if key in sketches else sketch
+    return sketches
+
+
+def sketch_baseline(sketches, method='mad', percentile_low=0.005, percentile_high=0.995):
+    '''
+    Baseline in the query 4 layout so the normal z-score scorer can use it. Neither method
+    depends on anomaly_threshold, it is applied when scoring.
+    mad:        centre = median, scale = 1.4826 * MAD, a robust z-score.
+    percentile: centre = midpoint and scale = half the distance of the percentile_low and
+                percentile_high quantiles, so |z| > 1 exactly outside them (score_anomalies
+                scales this to the threshold).
+    '''
+    robots = sorted(set(robot_name for robot_name, _ in sketches))
+    baseline = pd.DataFrame({'robot_name': robots})
+    for joint, mean_col, std_col in zip(JOINT_LIST, MEAN_LIST, STD_LIST):
+        centre, scale = [], []
+        for robot_name in robots:
+            sketch = sketches.get((robot_name, joint))
+            if sketch is None or sketch.n == 0:
+                centre.append(np.nan)
+                scale.append(np.nan)
+            elif method == 'percentile':
+                low, high = sketch.quantile([percentile_low, percentile_high])
+                centre.append((low + high) / 2)
+                scale.append((high - low) / 2)
+            else:
+                centre.append(sketch.quantile(0.5))
+                scale.append(MAD_SCALE * sketch.mad())
+        #Percentile centre/scale are not rounded, a value right at a quantile then scores exactly
+        #the threshold instead of just over or under it
+        if method != 'percentile':
+            centre, scale = np.round(centre, 5), np.round(scale, 5)
+        baseline[mean_col] = centre
+        baseline[std_col] = scale
+    return baseline
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+"""
+Column names shared by every module: the raw amp columns of public.everything, the per-minute
+joint columns of query 3 and the mean/std columns of stats_profile_baseline. A schema change is
+made here once.
+
+@author: bmkea
+"""
+
+#Raw table layout (public.everything)
+AMP_LIST = ['Amp_1', 'Amp_2', 'Amp_3', 'Amp_4', 'Amp_5', 'Amp_6']
+
+#Column names for each joint in the sample data and the matching baseline columns
+JOINT_LIST = ['max_amp_1', 'max_amp_2', 'max_amp_3', 'max_amp_4', 'max_amp_5', 'max_amp_6']
+MEAN_LIST = ['mean_of_max_amp_01', 'mean_of_max_amp_02', 'mean_of_max_amp_03',
+             'mean_of_max_amp_04', 'mean_of_max_amp_05', 'mean_of_max_amp_06']
+STD_LIST = ['std_of_max_amp_01', 'std_of_max_amp_02', 'std_of_max_amp_03',
+            'std_of_max_amp_04', 'std_of_max_amp_05', 'std_of_max_amp_06']
@@ -4,17 +4,623 @@ Created on Mon Jan 29 11:55:17 2024
 
 @author: bmkea
 """
+import argparse
 import logging
+import logging.handlers
+import cProfile
+import os
 import warnings
 import configparser
+import io
+import json
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from decimal import Decimal
+import numpy as np
 import pandas as pd
 import psycopg2 as pg
-import psycopg2.extras as extras
+import psycopg2.extensions as pg_extensions
+import psycopg2.pool as pg_pool
 import time
+from contextlib import contextmanager
+import data_sources
+import metrics
+import mqtt_ingest
+import quantile_sketch
+import window_store
+from schema import JOINT_LIST, MEAN_LIST, STD_LIST
+
+ANOMALY_COLUMNS = ['robot_name', 'joint', 'time_stamp', 'zscore', 'actual_value']
+ANOMALY_KEY_COLUMNS = ['robot_name', 'joint', 'time_stamp']
+MOMENT_COLUMNS = ['robot_name', 'joint', 'n', 'mean', 'm2']
+INV_COV_LIST = ['inv_cov_%d%d' % (i, j) for i in range(1, 7) for j in range(1, 7)]
+COV_MEAN_LIST = ['cov_mean_%d' % i for i in range(1, 7)]
+COVARIANCE_COLUMNS = ['robot_name', 'n', 'mean', 'covariance', 'inv_covariance', 'start_time', 'end_time']
+
+#Per-minute aggregate for each agg_type, {col} is the raw column
+AGG_SQL = {'max': 'MAX("{col}")', 'min': 'MIN("{col}")', 'mean': 'AVG("{col}")',
+           'p95': 'percentile_cont(0.95) WITHIN GROUP (ORDER BY "{col}")'}
+
+#Queries that are run as plain fetches (database_conn) or streamed (stream_query)
+#{amp_n} is filled with the agg_type aggregate of Amp_n, the max_amp_n names are kept for scoring
+#Results are cast to double precision so psycopg2 returns floats, not Decimal
+BASELINE_SQL = """SELECT "Robot_Name", MIN(time_by_minute) as start_time, MAX(time_by_minute) as end_time,
+            CAST(ROUND(AVG(max_amp_1), 5) as double precision) as mean_of_max_amp_01, CAST(ROUND(STDDEV(max_amp_1), 5) as double precision) as std_of_max_amp_01,
+            CAST(ROUND(AVG(max_amp_2), 5) as double precision) as mean_of_max_amp_02, CAST(ROUND(STDDEV(max_amp_2), 5) as double precision) as std_of_max_amp_02,
+            CAST(ROUND(AVG(max_amp_3), 5) as double precision) as mean_of_max_amp_03, CAST(ROUND(STDDEV(max_amp_3), 5) as double precision) as std_of_max_amp_03,
+            CAST(ROUND(AVG(max_amp_4), 5) as double precision) as mean_of_max_amp_04, CAST(ROUND(STDDEV(max_amp_4), 5) as double precision) as std_of_max_amp_04,
+            CAST(ROUND(AVG(max_amp_5), 5) as double precision) as mean_of_max_amp_05, CAST(ROUND(STDDEV(max_amp_5), 5) as double precision) as std_of_max_amp_05,
+            CAST(ROUND(AVG(max_amp_6), 5) as double precision) as mean_of_max_amp_06, CAST(ROUND(STDDEV(max_amp_6), 5) as double precision) as std_of_max_amp_06
+    FROM
+            (SELECT date_trunc('minute', "Time_Stamp") AS time_by_minute, "Robot_Name",
+                ROUND(CAST({amp_1} as numeric), 5) as max_amp_1, 
+                ROUND(CAST({amp_2} as numeric), 5) as max_amp_2, 
+                ROUND(CAST({amp_3} as numeric), 5) as max_amp_3, 
+                ROUND(CAST({amp_4} as numeric), 5) as max_amp_4, 
+                ROUND(CAST({amp_5} as numeric), 5) as max_amp_5, 
+                ROUND(CAST({amp_6} as numeric), 5) as max_amp_6
+                FROM public.everything
+                WHERE "Time_Stamp" > %(baseline_start_time)s and "Time_Stamp" < %(baseline_end_time)s
+                GROUP  BY 1, "Robot_Name"
+                ORDER BY time_by_minute ASC)
+    AS totals
+    GROUP BY "Robot_Name";
+    """
+
+SAMPLE_SQL = """SELECT date_trunc('minute', "Time_Stamp") AS time_by_minute, "Robot_Name",
+    CAST(ROUND(CAST({amp_1} as numeric), 5) as double precision) as max_amp_1, 
+    CAST(ROUND(CAST({amp_2} as numeric), 5) as double precision) as max_amp_2, 
+    CAST(ROUND(CAST({amp_3} as numeric), 5) as double precision) as max_amp_3, 
+    CAST(ROUND(CAST({amp_4} as numeric), 5) as double precision) as max_amp_4, 
+    CAST(ROUND(CAST({amp_5} as numeric), 5) as double precision) as max_amp_5, 
+    CAST(ROUND(CAST({amp_6} as numeric), 5) as double precision) as max_amp_6
+    FROM public.everything
+    WHERE "Time_Stamp" >= %(sample_start_time)s and "Time_Stamp" < %(sample_end_time)s
+    AND (%(robot_names)s::text[] IS NULL OR "Robot_Name" = ANY(%(robot_names)s::text[]))
+    GROUP  BY 1, "Robot_Name"
+    ORDER BY time_by_minute ASC;
+    """
+
+STORED_BASELINE_SQL = """SELECT * FROM public.stats_profile_baseline;"""
+
+#Per-minute rollup of public.everything, kept next to it in the raw database
+ROLLUP_TABLE_SQL = """CREATE TABLE IF NOT EXISTS public.stats_profile_rollup (
+                        agg_type text, robot_name text, time_by_minute timestamp,
+                        amp_1 double precision, amp_2 double precision, amp_3 double precision,
+                        amp_4 double precision, amp_5 double precision, amp_6 double precision,
+                        PRIMARY KEY (agg_type, robot_name, time_by_minute));
+                      CREATE TABLE IF NOT EXISTS public.stats_profile_rollup_chunks (
+                        agg_type text, chunk_start timestamp, chunk_end timestamp,
+                        PRIMARY KEY (agg_type, chunk_start));"""
+
+ROLLUP_UPDATE_SQL = """INSERT INTO public.stats_profile_rollup
+    (agg_type, time_by_minute, robot_name, amp_1, amp_2, amp_3, amp_4, amp_5, amp_6)
+    SELECT %(agg_type)s, date_trunc('minute', "Time_Stamp"), "Robot_Name",
+    ROUND(CAST({amp_1} as numeric), 5), ROUND(CAST({amp_2} as numeric), 5), ROUND(CAST({amp_3} as numeric), 5),
+    ROUND(CAST({amp_4} as numeric), 5), ROUND(CAST({amp_5} as numeric), 5), ROUND(CAST({amp_6} as numeric), 5)
+    FROM public.everything
+    WHERE "Time_Stamp" >= %(start_time)s and "Time_Stamp" < %(end_time)s
+    GROUP  BY 2, 3
+    ON CONFLICT (agg_type, robot_name, time_by_minute) DO UPDATE SET
+    amp_1 = EXCLUDED.amp_1, amp_2 = EXCLUDED.amp_2, amp_3 = EXCLUDED.amp_3,
+    amp_4 = EXCLUDED.amp_4, amp_5 = EXCLUDED.amp_5, amp_6 = EXCLUDED.amp_6;
+    """
+
+ROLLUP_BASELINE_SQL = """SELECT robot_name as "Robot_Name", MIN(time_by_minute) as start_time, MAX(time_by_minute) as end_time,
+            CAST(ROUND(CAST(AVG(amp_1) as numeric), 5) as double precision) as mean_of_max_amp_01, CAST(ROUND(CAST(STDDEV(amp_1) as numeric), 5) as double precision) as std_of_max_amp_01,
+            CAST(ROUND(CAST(AVG(amp_2) as numeric), 5) as double precision) as mean_of_max_amp_02, CAST(ROUND(CAST(STDDEV(amp_2) as numeric), 5) as double precision) as std_of_max_amp_02,
+            CAST(ROUND(CAST(AVG(amp_3) as numeric), 5) as double precision) as mean_of_max_amp_03, CAST(ROUND(CAST(STDDEV(amp_3) as numeric), 5) as double precision) as std_of_max_amp_03,
+            CAST(ROUND(CAST(AVG(amp_4) as numeric), 5) as double precision) as mean_of_max_amp_04, CAST(ROUND(CAST(STDDEV(amp_4) as numeric), 5) as double precision) as std_of_max_amp_04,
+            CAST(ROUND(CAST(AVG(amp_5) as numeric), 5) as double precision) as mean_of_max_amp_05, CAST(ROUND(CAST(STDDEV(amp_5) as numeric), 5) as double precision) as std_of_max_amp_05,
+            CAST(ROUND(CAST(AVG(amp_6) as numeric), 5) as double precision) as mean_of_max_amp_06, CAST(ROUND(CAST(STDDEV(amp_6) as numeric), 5) as double precision) as std_of_max_amp_06
+    FROM public.stats_profile_rollup
+    WHERE agg_type = %(agg_type)s and time_by_minute >= %(baseline_start_time)s and time_by_minute < %(baseline_end_time)s
+    GROUP BY robot_name;
+    """
+
+ROLLUP_SAMPLE_SQL = """SELECT time_by_minute, robot_name as "Robot_Name",
+    amp_1 as max_amp_1, amp_2 as max_amp_2, amp_3 as max_amp_3,
+    amp_4 as max_amp_4, amp_5 as max_amp_5, amp_6 as max_amp_6
+    FROM public.stats_profile_rollup
+    WHERE agg_type = %(agg_type)s and time_by_minute >= %(sample_start_time)s and time_by_minute < %(sample_end_time)s
+    AND (%(robot_names)s::text[] IS NULL OR robot_name = ANY(%(robot_names)s::text[]))
+    ORDER BY time_by_minute ASC;
+    """
+
+BASELINE_VERSION_SQL = """SELECT md5(COALESCE(string_agg(b::text, '|' ORDER BY b::text), '')) FROM public.stats_profile_baseline b;"""
+
+#Running moments for the incremental baseline, one row per robot/joint
+MOMENTS_TABLE_SQL = """CREATE TABLE IF NOT EXISTS public.stats_profile_moments (
+                        robot_name text, joint text, n double precision, mean double precision,
+                        m2 double precision, start_time timestamp, end_time timestamp);"""
+
+#Quantile sketch (t-digest centroids) per robot/joint, kept next to the baseline
+SKETCH_TABLE_SQL = """CREATE TABLE IF NOT EXISTS public.stats_profile_sketches (
+                        robot_name text, joint text, n double precision, min_value double precision,
+                        max_value double precision, centroids bytea, start_time timestamp, end_time timestamp);"""
+
+#Cross-joint covariance and its inverse per robot, for multivariate scoring
+COVARIANCE_TABLE_SQL = """CREATE TABLE IF NOT EXISTS public.stats_profile_covariance (
+                        robot_name text, n double precision, mean bytea, covariance bytea,
+                        inv_covariance bytea, start_time timestamp, end_time timestamp);"""
+
+#Stored tables read back by query number: create statement and select
+STORED_TABLES = {6: (MOMENTS_TABLE_SQL, "SELECT robot_name, joint, n, mean, m2, start_time, end_time FROM public.stats_profile_moments;"),
+                 11: (SKETCH_TABLE_SQL, "SELECT robot_name, joint, n, min_value, max_value, centroids, start_time, end_time FROM public.stats_profile_sketches;"),
+                 13: (COVARIANCE_TABLE_SQL, "SELECT robot_name, n, mean, covariance, inv_covariance, start_time, end_time FROM public.stats_profile_covariance;")}
+
+#Debug log line for each query case
+QUERY_LABELS = {1: 'Retrieving Raw Data', 2: 'Storing Baseline', 3: 'Retrieving Raw Data', 4: 'Retrieving Baseline',
+                5: 'Storing Anomalies', 6: 'Retrieving Baseline Moments', 7: 'Storing Baseline Moments',
+                8: 'Updating Rollup', 9: 'Replacing Anomalies', 10: 'Storing Baseline Sketches',
+                11: 'Retrieving Baseline Sketches', 12: 'Storing Baseline Covariance', 13: 'Retrieving Baseline Covariance'}
+
+
+def typed_frame(records, colnames):
+    '''
+    Build a dataframe from fetched rows with numeric (Decimal) columns converted to float64 once.
+    '''
+    dataframe = pd.DataFrame(data = records, columns = colnames)
+    for col in dataframe.columns:
+        if dataframe[col].dtype == object:
+            first = dataframe[col].first_valid_index()
+            if first is not None and isinstance(dataframe[col].iloc[first], Decimal):
+                dataframe[col] = dataframe[col].astype(np.float64)
+    return dataframe
+
+
+def minute_weights(minute_dataframe, end_time, decay):
+    '''
+    Weight of each minute for a decaying baseline: decay per day of age, measured back from
+    end_time. None (every minute weighs 1) when decay is 1.
+    '''
+    if decay >= 1:
+        return None
+    age = (pd.Timestamp(end_time) - pd.to_datetime(minute_dataframe['time_by_minute'])).dt.total_seconds() / 86400
+    return decay ** age.to_numpy(dtype=np.float64)
+
+
+def batch_moments(minute_dataframe, weights=None):
+    '''
+    Reduce per-minute maxima (query 3 layout) to count, mean and M2 per robot/joint. With
+    weights (one per minute) n is the total weight and mean/M2 are weighted.
+    '''
+    long = minute_dataframe.melt(id_vars=['Robot_Name'], value_vars=JOINT_LIST, var_name='joint', value_name='value')
+    long['weight'] = np.tile(np.ones(len(minute_dataframe)) if weights is None else weights, len(JOINT_LIST))
+    long = long.rename(columns={'Robot_Name': 'robot_name'}).dropna(subset=['value'])
+    long['value'] = long['value'].astype(np.float64)
+    long['weighted'] = long['weight'] * long['value']
+    grouped = long.groupby(['robot_name', 'joint'], sort=True)
+    n = grouped['weight'].transform('sum')
+    long['m2'] = long['weight'] * (long['value'] - grouped['weighted'].transform('sum') / n) ** 2
+    moments = grouped[['weight', 'weighted', 'm2']].sum().reset_index()
+    moments['weighted'] = moments['weighted'] / moments['weight']
+    moments.columns = MOMENT_COLUMNS
+    return moments
+
+
+def merge_moments(a, b, subtract=False):
+    '''
+    Combine two sets of moments (Chan et al. parallel update). With subtract=True the
+    moments in b are removed from a instead, which is the exact inverse of the merge.
+    '''
+    m = a.merge(b, on=['robot_name', 'joint'], how='outer', suffixes=('_a', '_b'))
+    if subtract:
+        #Only rows that exist in a can have data removed
+        m = m[m['n_a'].notna()]
+    na, ma, m2a = m['n_a'].fillna(0).to_numpy(), m['mean_a'].fillna(0).to_numpy(), m['m2_a'].fillna(0).to_numpy()
+    nb, mb, m2b = m['n_b'].fillna(0).to_numpy(), m['mean_b'].fillna(0).to_numpy(), m['m2_b'].fillna(0).to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if subtract:
+            n = na - nb
+            mean = np.where(n > 0, (na * ma - nb * mb) / n, 0.0)
+            delta = mb - mean
+            m2 = np.where(n > 0, m2a - m2b - delta ** 2 * n * nb / na, 0.0)
+        else:
+            n = na + nb
+            delta = mb - ma
+            mean = np.where(n > 0, ma + delta * nb / n, 0.0)
+            m2 = np.where(n > 0, m2a + m2b + delta ** 2 * na * nb / n, 0.0)
+    merged = pd.DataFrame({'robot_name': m['robot_name'].to_numpy(), 'joint': m['joint'].to_numpy(),
+                           'n': n, 'mean': mean, 'm2': np.maximum(m2, 0.0)})
+    return merged[merged['n'] > 0].sort_values(['robot_name', 'joint']).reset_index(drop=True)
+
+
+def decay_moments(moments, factor):
+    '''
+    Exponentially age moments by down-weighting the count and M2, the mean is unchanged.
+    Works the same on the co-moment dicts of batch_comoments.
+    '''
+    if isinstance(moments, dict):
+        return dict(moments, n=moments['n'] * factor, comoment=moments['comoment'] * factor)
+    return moments.assign(n=moments['n'] * factor, m2=moments['m2'] * factor)
+
+
+def moments_to_baseline(moments):
+    '''
+    Turn long running moments into the wide stats_profile_baseline layout (same as query 1).
+    Std is the sample standard deviation to match postgres STDDEV.
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        std = np.where(moments['n'] > 1, np.sqrt(moments['m2'] / (moments['n'] - 1)), np.nan)
+    stats = moments.assign(mean=moments['mean'].round(5), std=np.round(std, 5))
+    wide = stats.pivot(index='robot_name', columns='joint', values=['mean', 'std'])
+    baseline = stats.groupby('robot_name').agg(start_time=('start_time', 'min'), end_time=('end_time', 'max'))
+    for joint, mean_col, std_col in zip(JOINT_LIST, MEAN_LIST, STD_LIST):
+        baseline[mean_col] = wide[('mean', joint)] if ('mean', joint) in wide else np.nan
+        baseline[std_col] = wide[('std', joint)] if ('std', joint) in wide else np.nan
+    return baseline.reset_index()
+
+
+def batch_comoments(minute_dataframe, weights=None):
+    '''
+    Count, mean vector and co-moment matrix (sum of outer products of the deviations) of the six
+    joints per robot, from minutes in the query 3 layout. Minutes with a missing joint are skipped.
+    With weights (one per minute) the count is the total weight, as in batch_moments.
+    '''
+    complete = minute_dataframe[JOINT_LIST].notna().all(axis=1).to_numpy()
+    minutes = minute_dataframe[complete]
+    codes, robots = pd.factorize(minutes['Robot_Name'], sort=True)
+    if len(robots) == 0:
+        return {'robot_name': np.empty(0, dtype=object), 'n': np.empty(0), 'mean': np.empty((0, 6)), 'comoment': np.empty((0, 6, 6))}
+    order = np.argsort(codes, kind='mergesort')
+    codes, x = codes[order], minutes[JOINT_LIST].to_numpy(dtype=np.float64)[order]
+    w = np.ones(len(codes)) if weights is None else np.asarray(weights, dtype=np.float64)[complete][order]
+    starts = np.searchsorted(codes, np.arange(len(robots)))
+    n = np.add.reduceat(w, starts)
+    mean = np.add.reduceat(w[:, None] * x, starts, axis=0) / n[:, None]
+    d = x - mean[codes]
+    comoment = np.add.reduceat(w[:, None, None] * d[:, :, None] * d[:, None, :], starts, axis=0)
+    return {'robot_name': np.asarray(robots, dtype=object), 'n': n, 'mean': mean, 'comoment': comoment}
+
+
+def merge_comoments(a, b, subtract=False):
+    '''
+    Matrix version of merge_moments: combine two sets of co-moments per robot, or remove the
+    ones in b from a with subtract=True.
+    '''
+    robots = a['robot_name'] if subtract else np.union1d(a['robot_name'], b['robot_name']).astype(object)
+
+    def align(c):
+        index = pd.Index(c['robot_name']).get_indexer(robots)
+        found = index >= 0
+        n = np.where(found, c['n'][index] if len(c['n']) else 0.0, 0.0)
+        mean = np.where(found[:, None], c['mean'][index] if len(c['n']) else 0.0, 0.0)
+        comoment = np.where(found[:, None, None], c['comoment'][index] if len(c['n']) else 0.0, 0.0)
+        return n, mean, comoment
+
+    (na, ma, ca), (nb, mb, cb) = align(a), align(b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if subtract:
+            n = na - nb
+            mean = np.where(n[:, None] > 0, (na[:, None] * ma - nb[:, None] * mb) / n[:, None], 0.0)
+            delta = mb - mean
+            comoment = ca - cb - delta[:, :, None] * delta[:, None, :] * (n * nb / na)[:, None, None]
+        else:
+            n = na + nb
+            delta = mb - ma
+            mean = np.where(n[:, None] > 0, ma + delta * (nb / n)[:, None], 0.0)
+            comoment = ca + cb + delta[:, :, None] * delta[:, None, :] * (na * nb / n)[:, None, None]
+    keep = n > 0
+    return {'robot_name': robots[keep], 'n': n[keep], 'mean': mean[keep], 'comoment': np.nan_to_num(comoment[keep])}
+
+
+def partition_stats(minute_dataframe, parts, compression=100, end_time=None, decay=1.0):
+    '''
+    Mergeable statistics of one slice of baseline minutes (query 3 layout): quantile sketches,
+    co-moments and/or moments, whichever are named in parts.
+    '''
+    weights = minute_weights(minute_dataframe, end_time, decay)
+    stats = {}
+    if 'sketches' in parts:
+        stats['sketches'] = quantile_sketch.build_sketches(minute_dataframe, compression)
+    if 'comoments' in parts:
+        stats['comoments'] = batch_comoments(minute_dataframe, weights)
+    if 'moments' in parts:
+        stats['moments'] = batch_moments(minute_dataframe, weights)
+    return stats
+
+
+def merge_partition_stats(a, b):
+    #Merge the statistics of two slices, see partition_stats
+    merge = {'sketches': quantile_sketch.merge_sketches, 'comoments': merge_comoments, 'moments': merge_moments}
+    return {part: merge[part](a[part], b[part]) for part in a}
+
+
+def time_chunks(start_time, end_time, chunk_minutes):
+    #(chunk_start, chunk_end) of the chunk_minutes chunks, aligned to midnight for whole days,
+    #that overlap start_time to end_time (rollup chunks and sketch partitions)
+    freq = '%dmin' % chunk_minutes
+    edges = pd.date_range(pd.Timestamp(start_time).floor(freq), pd.Timestamp(end_time).ceil(freq), freq=freq)
+    return list(zip(edges[:-1], edges[1:]))
+
+def to_bytea(values):
+    #float64 array as postgres bytea hex text, so it can go through COPY
+    return '\\x' + np.asarray(values, dtype='<f8').tobytes().hex()
+
+
+def from_bytea(value, shape):
+    #Accepts the hex text written by to_bytea or the bytes/memoryview psycopg2 returns for bytea
+    if isinstance(value, str):
+        value = bytes.fromhex(value[2:] if value.startswith('\\x') else value)
+    return np.frombuffer(bytes(value), dtype='<f8').reshape(shape)
+
+
+def comoments_to_frame(comoments, start_time, end_time):
+    '''
+    Rows for stats_profile_covariance: sample covariance and its (pseudo) inverse per robot.
+    Robots with 6 or fewer minutes get a NaN inverse and are not scored.
+    '''
+    n = comoments['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        covariance = np.where((n > 1)[:, None, None], comoments['comoment'] / (n - 1)[:, None, None], 0.0)
+    inverse = np.linalg.pinv(covariance, hermitian=True) if len(n) else covariance
+    inverse[n <= 6] = np.nan
+    return pd.DataFrame({'robot_name': comoments['robot_name'], 'n': n,
+                         'mean': [to_bytea(m) for m in comoments['mean']],
+                         'covariance': [to_bytea(c) for c in covariance],
+                         'inv_covariance': [to_bytea(c) for c in inverse],
+                         'start_time': start_time, 'end_time': end_time}, columns=COVARIANCE_COLUMNS)
+
+
+def frame_to_comoments(dataframe):
+    n = dataframe['n'].to_numpy(dtype=np.float64)
+    covariance = np.array([from_bytea(c, (6, 6)) for c in dataframe['covariance']]).reshape(-1, 6, 6)
+    return {'robot_name': dataframe['robot_name'].to_numpy(dtype=object), 'n': n,
+            'mean': np.array([from_bytea(m, 6) for m in dataframe['mean']]).reshape(-1, 6),
+            'comoment': covariance * np.maximum(n - 1, 0)[:, None, None]}
+
+
+class postgres_source():
+    '''
+    Postgres data source (data_source = postgres), the raw database and the processed tables.
+    Same interface as data_sources.local_source: run() takes the query numbers of
+    statistical_profiling.database_conn and returns the same dataframes. Connection pools,
+    settings, metrics and logging belong to the statistical_profiling object that owns it.
+    '''
+    
+    def __init__(self, profile):
+        self.profile = profile
+    
+    def run(self, query, input_dataframe=False, params=None, key_columns=None):
+        '''
+        Run one query case, retrying with backoff. params are the dict query_params builds for
+        queries 1 and 3, or start_time/end_time for queries 8 and 9. key_columns turns the
+        anomaly insert (query 5) into an upsert. After db_max_retries the error is raised.
+        '''
+        profile = self.profile
+        
+        #With the rollup on, make sure it covers the window before reading from it
+        if query in (1, 3):
+            self.prepare(query, None if query == 1 else (params['sample_start_time'], params['sample_end_time']))
+        
+        #Keep trying until the query goes through, backing off each time
+        attempt = 0
+        while(True):
+            try:
+                profile.logger.debug('%s...' % QUERY_LABELS.get(query, 'Query %s' % query))
+                return self.execute(query, input_dataframe, params, key_columns)
+            except Exception as error:
+                
+                #Give up after db_max_retries, otherwise wait with exponential backoff
+                attempt += 1
+                profile.metrics.count('retries')
+                if attempt > profile.db_max_retries:
+                    profile.logger.error("Giving up on postgres after %s attempts: %s" % (attempt, error))
+                    raise
+                delay = min(profile.db_retry_base * 2 ** (attempt - 1), profile.db_retry_max)
+                profile.logger.debug("An exception occurred: %s – %s, retrying in %s seconds" % (type(error).__name__, error, delay))
+                time.sleep(delay)
+                profile.logger.debug("Reattempting postgres database connection...") 
+    
+    def execute(self, query, input_dataframe, params, key_columns):
+        #One attempt at a query case, reads return a dataframe and writes None
+        
+        #Raw data for the baseline (1) or the sample window (3), and the stored baseline (4)
+        if query in (1, 3, 4):
+            sql, _, database = self.profile.query_params(query)
+            return self.fetch(database, sql, params)
+        
+        #Stored moments (6), sketches (11) and covariance (13), tables are created on first use
+        elif query in STORED_TABLES:
+            create_sql, select_sql = STORED_TABLES[query]
+            return self.fetch('processed', select_sql, create_sql=create_sql)
+        
+        #Baseline (2), moments with the baseline derived from them (7, input is both frames),
+        #sketches (10) and covariance (12) replace the whole table
+        elif query == 2:
+            self.replace(['stats_profile_baseline'], [input_dataframe])
+        elif query == 7:
+            self.replace(['stats_profile_moments', 'stats_profile_baseline'], input_dataframe, create_sql=MOMENTS_TABLE_SQL)
+        elif query == 10:
+            self.replace(['stats_profile_sketches'], [input_dataframe], create_sql=SKETCH_TABLE_SQL)
+        elif query == 12:
+            self.replace(['stats_profile_covariance'], [input_dataframe], create_sql=COVARIANCE_TABLE_SQL)
+        
+        #Anomalies are appended, with upsert overlapping windows replace earlier rows
+        elif query == 5:
+            with self.transaction('processed') as cur:
+                self.profile.bulk_write(cur, input_dataframe, 'detected_anomalies', key_columns=key_columns)
+        
+        #Anomalies of a time range are replaced (backfill)
+        elif query == 9:
+            self.replace(['detected_anomalies'], [input_dataframe], where=('time_stamp', params['start_time'], params['end_time']))
+        
+        #Per-minute rollup is extended to cover a time range
+        elif query == 8:
+            self.extend_rollup(params['start_time'], params['end_time'])
+        else:
+            raise ValueError('Unknown query %s' % query)
+    
+    @contextmanager
+    def transaction(self, database):
+        '''
+        Cursor on a borrowed connection to the raw or processed database, committed when the block
+        ends. On error the transaction is rolled back, the connection dropped (it may be broken)
+        and the error re-raised, so run() retries and a failed write never counts as stored.
+        '''
+        profile = self.profile
+        conn = profile.get_connection(database)
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except (Exception, pg.Error):
+                pass
+            profile.release_connection(conn, discard=True)
+            raise
+        profile.release_connection(conn)
+    
+    def fetch(self, database, sql, params=None, create_sql=None):
+        #Run a select and return the rows as a typed dataframe
+        metrics = self.profile.metrics
+        with self.transaction(database) as cur:
+            if create_sql is not None:
+                cur.execute(create_sql)
+            started = time.perf_counter()
+            cur.execute(sql, params)
+            started = metrics.observe('query', started)
+            records = cur.fetchall()
+            started = metrics.observe('fetch', started, rows=len(records))
+            colnames = [desc[0] for desc in cur.description]
+        query_results = typed_frame(records, colnames)
+        metrics.observe('dataframe', started, rows=len(query_results))
+        return query_results
+    
+    def replace(self, tables, frames, create_sql=None, where=None):
+        '''
+        Replace the rows of each table with its frame in one transaction. DELETE rather than
+        TRUNCATE, so readers are never blocked. where (column, start, end) limits the delete
+        to a time range.
+        '''
+        with self.transaction('processed') as cur:
+            if create_sql is not None:
+                cur.execute(create_sql)
+            for table, frame in zip(tables, frames):
+                if where is None:
+                    cur.execute("DELETE FROM public.%s;" % table)
+                else:
+                    cur.execute("DELETE FROM public.%s WHERE %s >= %%s and %s < %%s;" % (table, where[0], where[0]), where[1:])
+                self.profile.bulk_write(cur, frame, table)
+    
+    def extend_rollup(self, start_time, end_time):
+        '''
+        Fill the per-minute rollup for start_time to end_time one rollup_chunk_minutes chunk at a
+        time, each chunk in its own transaction so the advisory lock is held for one chunk only.
+        A chunk that ended more than rollup_lateness_minutes ago is aggregated whole, once, and
+        recorded in stats_profile_rollup_chunks. Newer chunks can still get late raw rows, the
+        part of them asked for is aggregated again on every call and never recorded.
+        '''
+        profile = self.profile
+        chunks = time_chunks(start_time, end_time, profile.rollup_chunk_minutes)
+        if not chunks:
+            return
+        sealed_before = pd.Timestamp.now() - pd.Timedelta(minutes=profile.rollup_lateness_minutes)
+        covered = profile.rollup_covered.setdefault(profile.agg_type, set())
+        
+        #Chunks recorded by any process so far
+        with self.transaction('raw') as cur:
+            cur.execute(ROLLUP_TABLE_SQL)
+            cur.execute("""SELECT chunk_start FROM public.stats_profile_rollup_chunks
+                           WHERE agg_type = %s and chunk_start >= %s and chunk_start < %s;""",
+                        (profile.agg_type, chunks[0][0], chunks[-1][1]))
+            covered.update(pd.Timestamp(row[0]) for row in cur.fetchall())
+        
+        sql = ROLLUP_UPDATE_SQL.format(**profile.agg_columns())
+        for chunk_start, chunk_end in chunks:
+            if chunk_start in covered:
+                continue
+            sealed = chunk_end <= sealed_before
+            with self.transaction('raw') as cur:
+                
+                #One process rolls up at a time, a sealed chunk done while waiting is skipped
+                cur.execute("SELECT pg_advisory_xact_lock(hashtext('stats_profile_rollup'));")
+                if sealed:
+                    cur.execute("SELECT 1 FROM public.stats_profile_rollup_chunks WHERE agg_type = %s and chunk_start = %s;",
+                                (profile.agg_type, chunk_start))
+                    if cur.fetchone() is not None:
+                        covered.add(chunk_start)
+                        continue
+                    rollup_range = (chunk_start, chunk_end)
+                else:
+                    rollup_range = (max(start_time, chunk_start), min(end_time, chunk_end))
+                started = time.perf_counter()
+                cur.execute(sql, {'agg_type': profile.agg_type, 'start_time': rollup_range[0], 'end_time': rollup_range[1]})
+                profile.metrics.observe('rollup', started, rows=cur.rowcount)
+                if sealed:
+                    cur.execute("""INSERT INTO public.stats_profile_rollup_chunks (agg_type, chunk_start, chunk_end)
+                                   VALUES (%s, %s, %s) ON CONFLICT DO NOTHING;""", (profile.agg_type, chunk_start, chunk_end))
+            if sealed:
+                covered.add(chunk_start)
+    
+    def prepare(self, query, time_range=None):
+        #Roll up the window query 1 or 3 is about to read when use_rollup is on (see refresh_rollup)
+        if self.profile.use_rollup == 'True':
+            self.profile.refresh_rollup(query, time_range)
+    
+    def stream(self, query, params, fetch_size):
+        '''
+        Chunked version of run() for queries 1, 3 and 4. Uses a named (server side) cursor so postgres
+        hands back fetch_size rows at a time, and yields each batch as a typed dataframe
+        (numeric columns as float64). Memory is bounded by fetch_size, not by the window.
+        No retry once rows have been yielded, errors are raised to the caller.
+        '''
+        profile = self.profile
+        sql, _, database = profile.query_params(query)
+        if query in (1, 3):
+            self.prepare(query, None if query == 1 else (params['sample_start_time'], params['sample_end_time']))
+        conn = profile.get_connection(database)
+        try:
+            profile.logger.debug('Streaming query %s in chunks of %s rows...' % (query, fetch_size))
+            with conn.cursor(name='stats_profile_stream') as cur:
+                cur.itersize = fetch_size
+                started = time.perf_counter()
+                cur.execute(sql, params)
+                profile.metrics.observe('query', started)
+                while(True):
+                    started = time.perf_counter()
+                    records = cur.fetchmany(fetch_size)
+                    if not records:
+                        break
+                    started = profile.metrics.observe('fetch', started, rows=len(records))
+                    colnames = [desc[0] for desc in cur.description]
+                    chunk = typed_frame(records, colnames)
+                    profile.metrics.observe('dataframe', started, rows=len(chunk))
+                    yield chunk
+        except Exception:
+            profile.release_connection(conn, discard=True)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                profile.release_connection(conn)
+    
+    def version(self):
+        #md5 of the stored baseline table, one attempt only (no retry) so an outage doesn't block scoring
+        profile = self.profile
+        conn = profile.get_connection('processed')
+        try:
+            with conn.cursor() as cur:
+                cur.execute(BASELINE_VERSION_SQL)
+                return cur.fetchone()[0]
+        except Exception:
+            profile.release_connection(conn, discard=True)
+            conn = None
+            raise
+        finally:
+            if conn is not None:
+                profile.release_connection(conn)
+
 
 class statistical_profiling():
     
-    def __init__(self):
+    def __init__(self, log_file=True):
 
         #Set basic logging parameters, info --> logfile, debug --> console
         #Set logging format
@@ -23,21 +629,28 @@ class statistical_profiling():
         #Initiate logger object
         self.logger = logging.getLogger(__name__)
         
-        #Create console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(logging.DEBUG) ###########make sure to change back to INFO once debug is complete
-        console_handler.setFormatter(log_format)
-        
-        #add console handler to logger
-        self.logger.addHandler(console_handler)
-        
-        #create file handler
-        file_handler = logging.FileHandler('logfile.log', mode='a')
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(log_format)
-        
-        #add file handler
-        self.logger.addHandler(file_handler)
+        #Handlers are added once per process, worker processes create their own object
+        if not self.logger.handlers:
+            
+            #Create console handler
+            console_handler = logging.StreamHandler()
+            console_handler.setLevel(logging.DEBUG) ###########make sure to change back to INFO once debug is complete
+            console_handler.setFormatter(log_format)
+            
+            #add console handler to logger
+            self.logger.addHandler(console_handler)
+            
+            #Only the main process writes logfile.log, worker processes (log_file=False) log to the
+            #console so several processes never rotate the same file
+            if log_file:
+                
+                #create file handler (rotated so the log can't grow without bound)
+                file_handler = logging.handlers.RotatingFileHandler('logfile.log', mode='a', maxBytes=10000000, backupCount=5)
+                file_handler.setLevel(logging.DEBUG)
+                file_handler.setFormatter(log_format)
+                
+                #add file handler
+                self.logger.addHandler(file_handler)
         
         #set default logger level
         self.logger.setLevel(logging.DEBUG)
@@ -46,6 +659,35 @@ class statistical_profiling():
         self.logger.debug('Initializing...')
 
         
+        #Per-stage timings and counters (see metrics.py)
+        self.metrics = metrics.stage_metrics()
+        
+        #Connection pools for raw and processed databases, created on first use (under pool_lock,
+        #pipeline threads may ask for the same pool at once)
+        self.pools = {}
+        self.pool_lock = threading.Lock()
+        self.borrowed = {}
+        self.last_used = {}
+        
+        #In-memory copy of the baseline cache (metadata, dataframe)
+        self.cached_baseline = None
+        
+        #Inverse covariance columns for multivariate scoring (baseline version, dataframe)
+        self.cached_covariance = None
+        
+        #Worker process pool (workers > 1), created on first use and kept across cycles
+        self.executor = None
+        self.executor_workers = 0
+        
+        #Data source (postgres_source or data_sources.local_source), created on first use
+        self.source = None
+        
+        #Start times of the rollup chunks known to be filled, per agg_type
+        self.rollup_covered = {}
+        
+        #Rolling window of recent minutes (baseline_source = rolling or ewma), created on first use
+        self.window_store = None
+        
         #Ignore Deprecation Wanring
         warnings.filterwarnings("ignore", category=DeprecationWarning) 
         
@@ -55,8 +697,68 @@ class statistical_profiling():
         #Read Parameters from Config file
         self.get_parameters()
         
+        #Long running scheduler, otherwise one pass over the sample window in config
+        try:
+            if self.run_mode == 'daemon':
+                self.run_daemon()
+            elif self.run_mode == 'mqtt':
+                self.run_mqtt()
+            else:
+                self.run_cycle()
+        finally:
+            self.close_executor()
+            self.close_pools()
+            self.metrics.close()
+    
+    def run_cycle(self, time_range=None):
+        '''
+        One detection pass with timing, optional cProfile (profile_cycles, re-read from config
+        every daemon tick so it can be switched on at runtime) and metrics export.
+        Returns the number of anomalies stored, or None if processing failed.
+        '''
+        profiler = None
+        if self.profile_cycles == 'True':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        started = time.perf_counter()
+        stored = None
+        try:
+            stored = self.process_window(time_range=time_range)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, 'cycle_%s.prof' % time.strftime('%Y%m%d_%H%M%S')))
+            self.metrics.observe('cycle', started)
+            if stored is None:
+                self.metrics.count('failed_cycles')
+            else:
+                self.metrics.count('anomalies', stored)
+            self.export_metrics()
+        return stored
+    
+    def export_metrics(self):
+        #Write the metrics file and/or start the metrics endpoint, both optional
+        if self.metrics_file:
+            self.metrics.write_textfile(self.metrics_file)
+        if self.metrics_port > 0:
+            self.metrics.serve(self.metrics_port)
+    
+    def process_window(self, time_range=None):
+        '''
+        Keep the baseline current, score the sample window and store anomalies.
+        Returns the number of anomalies stored, or None if processing failed.
+        '''
+        #Incremental baseline folds new data into running moments every run
+        if self.baseline_mode == 'incremental':
+            self.update_baseline(rebuild=(self.reset_baseline == 'True'))
+            
+            #Flip baseline reset flag
+            if self.reset_baseline == 'True':
+                self.get_parameters(write=True)
+        
         #Check for resetting baseline flag
-        if self.reset_baseline == 'True':
+        elif self.reset_baseline == 'True':
             
             #Reset Baseline
             self.set_baseline()
@@ -64,13 +766,117 @@ class statistical_profiling():
             #Flip baseline reset flag
             self.get_parameters(write=True)
         
+        #Parallel mode splits the window across worker processes (table baseline only, a rolling
+        #baseline has to see every minute in order)
+        if self.workers > 1 and self.baseline_source == 'table':
+            anomalies = self.parallel_processing(time_range=time_range)
+            if anomalies is None:
+                return None
+            if len(anomalies) > 0:
+                self.database_conn(query=5, input_dataframe=anomalies)
+            return len(anomalies)
+        
+        #Pipelined mode overlaps baseline fetch, sample fetch, scoring and writes
+        elif self.pipeline == 'True':
+            return self.pipeline_processing(time_range=time_range)
+        
+        #Streaming mode scores and stores one chunk at a time
+        elif self.fetch_size > 0:
+            stored = 0
+            try:
+                for anomalies in self.stream_anomalies(time_range=time_range):
+                    if len(anomalies) > 0:
+                        self.database_conn(query=5, input_dataframe=anomalies)
+                    stored += len(anomalies)
+            except Exception as error:
+                self.logger.error('Streaming failed: %s – %s' % (type(error).__name__, error))
+                return None
+            return stored
+        
         #Check for anomalies
-        anomalies = self.data_processing()
+        anomalies = self.data_processing(time_range=time_range)
+        if anomalies is None:
+            return None
         
         #Store Anomalies in Postgres
-        if len(anomalies) > 1:
+        if len(anomalies) > 0:
             self.database_conn(query=5, input_dataframe=anomalies)       
         
+        return len(anomalies)
+    
+    def run_daemon(self):
+        '''
+        Wake every agg_interval, score only the raw rows newer than the persisted watermark,
+        store the anomalies and advance the watermark. Only whole minutes are scored so a
+        minute is never split across two cycles, and minutes younger than daemon_lateness
+        seconds are left for the next cycle so late raw rows still make it in. A cycle scores
+        at most daemon_max_minutes, after an outage (or on the first start) the daemon catches
+        up cycle after cycle without sleeping instead of fetching the whole gap at once.
+        '''
+        self.logger.info('Starting daemon mode, interval %s seconds...' % self.send_interval)
+        next_run = time.time()
+        while(True):
+            try:
+                #Pick up config changes (reset_baseline, threshold) between cycles
+                self.get_parameters()
+                
+                start_time = self.read_watermark()
+                ready_time = (pd.Timestamp.now() - pd.Timedelta(seconds=self.daemon_lateness)).floor('min')
+                end_time = min(ready_time, start_time + pd.Timedelta(minutes=self.daemon_max_minutes))
+                catching_up = False
+                if end_time > start_time:
+                    self.logger.debug('Scoring %s to %s...' % (start_time, end_time))
+                    try:
+                        anomalies = self.run_cycle(time_range=(str(start_time), str(end_time)))
+                    except Exception as error:
+                        #Database gave up retrying, keep the watermark and try again next tick
+                        self.logger.error('Cycle failed: %s – %s' % (type(error).__name__, error))
+                        anomalies = None
+                    
+                    #Only move the watermark once the window has been scored and stored
+                    if anomalies is not None:
+                        self.write_watermark(end_time)
+                        catching_up = end_time < ready_time
+                
+                #Sleep until next tick, skip ticks that were missed while busy (or still catching up)
+                next_run += self.send_interval
+                if catching_up or next_run < time.time():
+                    next_run = time.time()
+                time.sleep(max(next_run - time.time(), 0))
+                
+            except KeyboardInterrupt:
+                self.logger.info('Stopping daemon mode...')
+                break
+    
+    def run_mqtt(self):
+        '''
+        Streaming mode: aggregate robot messages from the MQTT broker into minute buckets in
+        memory and score each minute as soon as it closes (see mqtt_ingest.py).
+        '''
+        self.logger.info('Starting mqtt ingestion from %s:%s...' % (self.broker, self.port))
+        mqtt_ingest.mqtt_ingest(self).run()
+    
+    def read_watermark(self):
+        '''
+        Timestamp of the last scored minute. Without a watermark file the daemon starts at
+        sample_end_time (the window a single run would already have scored), or one agg_interval
+        back from now when no sample window is configured.
+        '''
+        try:
+            with open(self.watermark_file, 'r') as watermark:
+                return pd.Timestamp(watermark.read().strip())
+        except (FileNotFoundError, ValueError):
+            if self.sample_end_time:
+                return pd.Timestamp(self.sample_end_time)
+            return pd.Timestamp.now().floor('min') - pd.Timedelta(self.agg_interval)
+    
+    def write_watermark(self, timestamp):
+        #Write to a temp file then rename, so a crash never leaves a half written watermark
+        temp_file = self.watermark_file + '.tmp'
+        with open(temp_file, 'w') as watermark:
+            watermark.write(str(timestamp))
+        os.replace(temp_file, self.watermark_file)
+        
     def get_parameters(self, write=False):
         
         #Create config object
@@ -92,15 +898,78 @@ class statistical_profiling():
             self.raw_db_username = config.get('stats_config', 'raw_db_username')
             self.raw_db_password = config.get('stats_config', 'raw_db_password')
             self.raw_db_name = config.get('stats_config', 'raw_db_name')
-            self.processed_db_address = config.get('stats_config', 'raw_db_address')
-            self.processed_db_username = config.get('stats_config', 'raw_db_username')
-            self.processed_db_password = config.get('stats_config', 'raw_db_password')
-            self.processed_db_name = config.get('stats_config', 'raw_db_name')
+            self.processed_db_address = config.get('stats_config', 'processed_db_address')
+            self.processed_db_username = config.get('stats_config', 'processed_db_username')
+            self.processed_db_password = config.get('stats_config', 'processed_db_password')
+            self.processed_db_name = config.get('stats_config', 'processed_db_name')
             self.reset_baseline = config.get('stats_config', 'reset_baseline')
             self.baseline_start_time = config.get('stats_config', 'baseline_start_time')
             self.baseline_end_time = config.get('stats_config', 'baseline_end_time')
             self.sample_start_time = config.get('stats_config', 'sample_start_time')
             self.sample_end_time = config.get('stats_config', 'sample_end_time')
+            self.baseline_mode = config.get('stats_config', 'baseline_mode', fallback='full')
+            self.baseline_decay = config.get('stats_config', 'baseline_decay', fallback='1')
+            self.anomaly_upsert = config.get('stats_config', 'anomaly_upsert', fallback='False')
+            self.fetch_size = int(config.get('stats_config', 'fetch_size', fallback='0'))
+            self.workers = int(config.get('stats_config', 'workers', fallback='1'))
+            self.robot_groups = int(config.get('stats_config', 'robot_groups', fallback='1'))
+            self.time_slices = int(config.get('stats_config', 'time_slices', fallback='1'))
+            self.baseline_cache = config.get('stats_config', 'baseline_cache', fallback='False')
+            self.baseline_cache_file = config.get('stats_config', 'baseline_cache_file', fallback='baseline_cache')
+            self.baseline_cache_ttl = float(config.get('stats_config', 'baseline_cache_ttl', fallback='300'))
+            self.data_source = config.get('stats_config', 'data_source', fallback='postgres')
+            self.local_data_dir = config.get('stats_config', 'local_data_dir', fallback='local_data')
+            self.metrics_file = config.get('stats_config', 'metrics_file', fallback='')
+            self.metrics_port = int(config.get('stats_config', 'metrics_port', fallback='0'))
+            self.profile_cycles = config.get('stats_config', 'profile_cycles', fallback='False')
+            self.profile_dir = config.get('stats_config', 'profile_dir', fallback='profiles')
+            self.console_log_level = config.get('stats_config', 'console_log_level', fallback='INFO')
+            self.file_log_level = config.get('stats_config', 'file_log_level', fallback='INFO')
+            self.set_log_levels(self.console_log_level, self.file_log_level)
+            self.use_rollup = config.get('stats_config', 'use_rollup', fallback='False')
+            self.rollup_chunk_minutes = int(config.get('stats_config', 'rollup_chunk_minutes', fallback='1440'))
+            self.rollup_lateness_minutes = int(config.get('stats_config', 'rollup_lateness_minutes', fallback='60'))
+            self.broker = config.get('stats_config', 'broker')
+            self.port = int(config.get('stats_config', 'port'))
+            self.mqtt_topic = config.get('stats_config', 'mqtt_topic', fallback='robots/#')
+            self.mqtt_anomaly_topic = config.get('stats_config', 'mqtt_anomaly_topic', fallback='')
+            self.mqtt_lateness = float(config.get('stats_config', 'mqtt_lateness', fallback='5'))
+            self.mqtt_write = config.get('stats_config', 'mqtt_write', fallback='True')
+            self.mqtt_write_interval = float(config.get('stats_config', 'mqtt_write_interval', fallback='60'))
+            self.mqtt_write_batch = int(config.get('stats_config', 'mqtt_write_batch', fallback='10000'))
+            self.baseline_source = config.get('stats_config', 'baseline_source', fallback='table')
+            self.window_minutes = int(config.get('stats_config', 'window_minutes', fallback='60'))
+            self.window_dtype = config.get('stats_config', 'window_dtype', fallback='float32')
+            self.window_min_minutes = int(config.get('stats_config', 'window_min_minutes', fallback='10'))
+            self.ewma_alpha = float(config.get('stats_config', 'ewma_alpha', fallback='0.1'))
+            self.window_store_file = config.get('stats_config', 'window_store_file', fallback='')
+            self.pipeline = config.get('stats_config', 'pipeline', fallback='False')
+            self.pipeline_queue = int(config.get('stats_config', 'pipeline_queue', fallback='4'))
+            self.pipeline_write_batch = int(config.get('stats_config', 'pipeline_write_batch', fallback='50000'))
+            self.backfill_chunk_minutes = int(config.get('stats_config', 'backfill_chunk_minutes', fallback='60'))
+            self.backfill_workers = int(config.get('stats_config', 'backfill_workers', fallback='4'))
+            self.backfill_checkpoint = config.get('stats_config', 'backfill_checkpoint', fallback='backfill_checkpoint.json')
+            self.baseline_sketches = config.get('stats_config', 'baseline_sketches', fallback='False')
+            self.threshold_mode = config.get('stats_config', 'threshold_mode', fallback='zscore')
+            self.sketch_compression = int(config.get('stats_config', 'sketch_compression', fallback='100'))
+            self.sketch_partition_minutes = int(config.get('stats_config', 'sketch_partition_minutes', fallback='1440'))
+            self.percentile_low = float(config.get('stats_config', 'percentile_low', fallback='0.005'))
+            self.percentile_high = float(config.get('stats_config', 'percentile_high', fallback='0.995'))
+            self.scoring_mode = config.get('stats_config', 'scoring_mode', fallback='univariate')
+            self.mahalanobis_threshold = float(config.get('stats_config', 'mahalanobis_threshold', fallback='4.74'))
+            
+            #Multivariate scoring reads the stored covariance, a rolling/EWMA baseline has none
+            if self.scoring_mode == 'multivariate' and self.baseline_source != 'table':
+                raise ValueError('scoring_mode = multivariate needs baseline_source = table, not %s' % self.baseline_source)
+            self.run_mode = config.get('stats_config', 'run_mode', fallback='once')
+            self.watermark_file = config.get('stats_config', 'watermark_file', fallback='watermark.txt')
+            self.daemon_lateness = float(config.get('stats_config', 'daemon_lateness', fallback='60'))
+            self.daemon_max_minutes = int(config.get('stats_config', 'daemon_max_minutes', fallback='60'))
+            self.db_pool_max = int(config.get('stats_config', 'db_pool_max', fallback='4'))
+            self.db_max_retries = int(config.get('stats_config', 'db_max_retries', fallback='5'))
+            self.db_retry_base = float(config.get('stats_config', 'db_retry_base', fallback='1'))
+            self.db_retry_max = float(config.get('stats_config', 'db_retry_max', fallback='60'))
+            self.db_health_check = float(config.get('stats_config', 'db_health_check', fallback='30'))
         
         #Write to parameters
         elif write == True:
@@ -117,297 +986,570 @@ class statistical_profiling():
         
         
         
+    def set_log_levels(self, console_level, file_level):
+        #Apply log levels from config, logger level follows the most verbose handler
+        for handler in self.logger.handlers:
+            if isinstance(handler, logging.FileHandler):
+                handler.setLevel(file_level.upper())
+            else:
+                handler.setLevel(console_level.upper())
+        self.logger.setLevel(min(logging.getLevelName(console_level.upper()), logging.getLevelName(file_level.upper())))
+        
     def set_baseline(self):
         self.logger.debug('Building baseline from historical data...')
-        dataframe = self.database_conn(query=1)
+        
+        #Plain z-score baseline is aggregated in the database, nothing needs the minutes here
+        if not self.use_sketches() and self.scoring_mode != 'multivariate':
+            dataframe = self.database_conn(query=1)
+            self.database_conn(query=2, input_dataframe=dataframe)
+            self.invalidate_baseline_cache()
+            return dataframe
+        
+        #Otherwise the baseline minutes are read once and every statistic is built from that scan
+        parts = []
+        if self.use_sketches():
+            parts.append('sketches')
+        if self.scoring_mode == 'multivariate':
+            parts.append('comoments')
+        if self.threshold_mode == 'zscore':
+            parts.append('moments')
+        stats = self.scan_baseline(parts)
+        
+        if self.use_sketches():
+            self.database_conn(query=10, input_dataframe=stats['sketch_frame'])
+        if self.threshold_mode == 'zscore':
+            dataframe = moments_to_baseline(stats['moments'].assign(start_time=pd.Timestamp(self.baseline_start_time),
+                                                                    end_time=pd.Timestamp(self.baseline_end_time)))
+        else:
+            dataframe = self.robust_baseline(stats['sketches'], self.baseline_start_time, self.baseline_end_time)
+        if self.scoring_mode == 'multivariate':
+            self.database_conn(query=12, input_dataframe=comoments_to_frame(
+                stats['comoments'], self.baseline_start_time, self.baseline_end_time))
         self.database_conn(query=2, input_dataframe=dataframe)
+        self.invalidate_baseline_cache()
         return dataframe
+
+    def use_sketches(self):
+        #Sketches are built when asked for, and always for the robust threshold modes
+        if self.threshold_mode not in ('zscore', 'mad', 'percentile'):
+            raise ValueError('threshold_mode must be zscore, mad or percentile, not %s' % self.threshold_mode)
+        return self.baseline_sketches == 'True' or self.threshold_mode != 'zscore'
+
+    def scan_baseline(self, parts, decay=1.0):
+        '''
+        One pass over the baseline window minutes (query 3) that builds every statistic in parts
+        (sketches, comoments, moments) from the same fetch. The window is split into
+        sketch_partition_minutes partitions (see baseline_partitions), each partition is fetched
+        and reduced on its own, in worker processes when workers > 1, and the partition results
+        are merged. The sketches are also returned per partition as stats_profile_sketches rows
+        (sketch_frame). With decay < 1 the co-moments and moments are weighted as in update_baseline.
+        '''
+        end_time = pd.Timestamp(self.baseline_end_time)
+        partitions = [(str(s0), str(s1)) for s0, s1 in self.baseline_partitions()]
+        self.logger.debug('Scanning baseline in %s partitions for %s...' % (len(partitions), ', '.join(parts)))
+
+        started = time.perf_counter()
+        if self.workers > 1 and len(partitions) > 1:
+            count = len(partitions)
+            results = dict(self.get_executor(self.workers).map(baseline_partition, range(count), partitions, [parts] * count,
+                                                               [str(end_time)] * count, [decay] * count,
+                                                               [self.worker_settings()] * count))
+        else:
+            results = {index: partition_stats(self.database_conn(query=3, time_range=partition), parts,
+                                              self.sketch_compression, end_time, decay)
+                       for index, partition in enumerate(partitions)}
+
+        #Sketches are stored per partition, written out before the merge combines them in place
+        if 'sketches' in parts:
+            sketch_frame = pd.concat([quantile_sketch.sketches_to_frame(results[index]['sketches'], pd.Timestamp(s0), pd.Timestamp(s1))
+                                      for index, (s0, s1) in enumerate(partitions)], ignore_index=True)
         
+        #Merged in partition order so the result doesn't depend on which worker finished first
+        stats = results[0]
+        for index in range(1, len(partitions)):
+            stats = merge_partition_stats(stats, results[index])
+        if 'sketches' in parts:
+            stats['sketch_frame'] = sketch_frame
+        self.metrics.observe('baseline_scan', started, rows=len(partitions))
+        return stats
+    
+    def baseline_partitions(self):
+        #sketch_partition_minutes partitions of the baseline window (whole days by default), aligned
+        #the same way whatever the window, cut to the window at both ends
+        start_time, end_time = pd.Timestamp(self.baseline_start_time), pd.Timestamp(self.baseline_end_time)
+        return [(max(s, start_time), min(e, end_time)) for s, e in time_chunks(start_time, end_time, self.sketch_partition_minutes)]
+    
+    def update_sketches(self, stored_sketches, new_minutes, new_from):
+        '''
+        Sketch rows (stats_profile_sketches) for the baseline window, one sketch per robot/joint
+        and partition (see baseline_partitions). A stored partition that still covers its part of
+        the window is kept, and if only its end is missing the new minutes are merged into it.
+        Partitions that left the window are dropped, and a partition cut by the new window start
+        (or stored with another partition size) is built again from its minutes, so old data
+        leaves the sketches one partition at a time. new_minutes hold the minutes from new_from
+        on, any other minutes needed are fetched.
+        '''
+        stored = {}
+        if stored_sketches is not None:
+            stored = {pd.Timestamp(s): rows for s, rows in stored_sketches.groupby('start_time', sort=True)}
         
-    def database_conn(self, query=1, input_dataframe=False):
-        ''' 
-        This method handles all connections and queries used in the program. Database credentials are defined in config file.
+        def partition_minutes(start_time, end_time):
+            if new_minutes is not None and start_time >= new_from:
+                times = pd.to_datetime(new_minutes['time_by_minute'])
+                return new_minutes[(times >= start_time) & (times < end_time)]
+            return self.database_conn(query=3, time_range=(str(start_time), str(end_time)))
         
-        ''' 
-        #Keep trying database connection until a god connection is made
-        while(True):
-            try:
-                self.logger.debug("Connecting to postgres database...")
-                
-                #Decide which query will be called
-                #Case in witch raw data is needed to reset baseline
-                if query==1:
-                
-                    #Attempt Initial Connection to database where raw data is stored
-                    conn = pg.connect(
-                        host=str(self.raw_db_address),
-                        database=self.raw_db_name,
-                        user=self.raw_db_username,
-                        password=self.raw_db_password)
-                    
+        frames = []
+        for partition_start, partition_end in self.baseline_partitions():
+            rows = stored.get(partition_start)
+            stored_end = None if rows is None else pd.Timestamp(rows['end_time'].max())
+            if stored_end == partition_end:
+                frames.append(rows)
+                continue
+            if stored_end is not None and stored_end < partition_end:
+                sketches = quantile_sketch.merge_sketches(quantile_sketch.frame_to_sketches(rows, self.sketch_compression),
+                                                          quantile_sketch.build_sketches(partition_minutes(stored_end, partition_end), self.sketch_compression))
+            else:
+                sketches = quantile_sketch.build_sketches(partition_minutes(partition_start, partition_end), self.sketch_compression)
+            frames.append(quantile_sketch.sketches_to_frame(sketches, partition_start, partition_end))
+        return pd.concat(frames, ignore_index=True)
+
+    def robust_baseline(self, sketches, start_time, end_time):
+        #Baseline table rows (query 2 layout) for threshold_mode mad or percentile
+        baseline = quantile_sketch.sketch_baseline(sketches, self.threshold_mode, self.percentile_low, self.percentile_high)
+        baseline.insert(1, 'start_time', pd.Timestamp(start_time))
+        baseline.insert(2, 'end_time', pd.Timestamp(end_time))
+        return baseline
     
-                    self.logger.debug('Retrieving Raw Data...')
-                    #Open a cursor to perform database operations
-                    cur = conn.cursor()
-                    
-                    #Build Dynamic Query
-                    sql = """SELECT "Robot_Name", MIN(time_by_minute) as start_time, MAX(time_by_minute) as end_time,
-                    		ROUND(AVG(max_amp_1), 5) as mean_of_max_amp_01, ROUND(STDDEV(max_amp_1), 5) as std_of_max_amp_01,
-                    		ROUND(AVG(max_amp_2), 5) as mean_of_max_amp_02, ROUND(STDDEV(max_amp_2), 5) as std_of_max_amp_02,
-                    		ROUND(AVG(max_amp_3), 5) as mean_of_max_amp_03, ROUND(STDDEV(max_amp_3), 5) as std_of_max_amp_03,
-                    		ROUND(AVG(max_amp_4), 5) as mean_of_max_amp_04, ROUND(STDDEV(max_amp_4), 5) as std_of_max_amp_04,
-                    		ROUND(AVG(max_amp_5), 5) as mean_of_max_amp_05, ROUND(STDDEV(max_amp_5), 5) as std_of_max_amp_05,
-                    		ROUND(AVG(max_amp_6), 5) as mean_of_max_amp_06, ROUND(STDDEV(max_amp_6), 5) as std_of_max_amp_06
-                    FROM
-                    		(SELECT date_trunc('minute', "Time_Stamp") AS time_by_minute, "Robot_Name",
-                    			ROUND(CAST(MAX("Amp_1") as numeric), 5) as max_amp_1, 
-                    			ROUND(CAST(MAX("Amp_2") as numeric), 5) as max_amp_2, 
-                    			ROUND(CAST(MAX("Amp_3") as numeric), 5) as max_amp_3, 
-                    			ROUND(CAST(MAX("Amp_4") as numeric), 5) as max_amp_4, 
-                    			ROUND(CAST(MAX("Amp_5") as numeric), 5) as max_amp_5, 
-                    			ROUND(CAST(MAX("Amp_6") as numeric), 5) as max_amp_6
-                    			FROM public.everything
-                    			WHERE "Time_Stamp" > %(baseline_start_time)s and "Time_Stamp" < %(baseline_end_time)s
-                    			GROUP  BY 1, "Robot_Name"
-                    			ORDER BY time_by_minute ASC)
-                    AS totals
-                    GROUP BY "Robot_Name";
-                            """
-                    
-                    #Execute Query
-                    cur.execute(sql, {'baseline_start_time':self.baseline_start_time, 'baseline_end_time':self.baseline_end_time})
-                    
-                    #Get query Result regardless of query case
-                    #Get Column names from query
-                    colnames = [desc[0] for desc in cur.description]
-                    
-                    # Retrieve query results
-                    records = cur.fetchall()
-                    
-                    #Convert to Pandas Dataframe for Processing
-                    query_results = pd.DataFrame(data = records, columns = colnames) 
+    def update_baseline(self, rebuild=False):
+        '''
+        Incremental baseline. Each robot/joint is kept as running moments (n, mean, M2) in
+        stats_profile_moments. Only minutes added to the front of the baseline window are fetched
+        and folded in, minutes dropped from the back of the window are subtracted. With
+        baseline_decay < 1 every minute is weighted by baseline_decay per day of age (measured from
+        the end of the window), so old moments are only aged by the time the window moved forward
+        and subtracted minutes are removed with the weight they have at that point. The result is
+        the same as a full rebuild with the same weights. stats_profile_baseline is then rewritten
+        from the moments so scoring reads it the same way as a full rebuild. Nothing is written
+        when the window hasn't moved, and a window moved back or cut short is rebuilt.
+        With sketches on, the new minutes are merged into the stored per-partition sketches and
+        partitions that left the window are dropped (see update_sketches). With
+        scoring_mode = multivariate the per-robot co-moments
+        behind the covariance are updated the same way as the moments.
+        '''
+        self.logger.debug('Updating baseline moments...')
+        moments = None if rebuild else self.database_conn(query=6)
+        stored_sketches = None if rebuild or not self.use_sketches() else self.database_conn(query=11)
+        stored_covariance = None if rebuild or self.scoring_mode != 'multivariate' else self.database_conn(query=13)
+        new_minutes, old_minutes = None, None
+        decay = float(self.baseline_decay)
 
-                    return query_results                               
-                
-                #Case in which processed baseline needs to be stored to a database    
-                elif query==2:
-                    
-                    #Attempt Initial Connection to database where baseline is stored
-                    conn = pg.connect(
-                        host=str(self.processed_db_address),
-                        database=self.processed_db_name,
-                        user=self.processed_db_username,
-                        password=self.processed_db_password)
-                    
+        #Nothing stored yet (or rebuild asked for), build moments over the whole window once
+        if moments is None or len(moments) == 0:
+            minutes = self.database_conn(query=3, time_range=(self.baseline_start_time, self.baseline_end_time))
+            start_time, end_time = pd.Timestamp(self.baseline_start_time), pd.Timestamp(self.baseline_end_time)
+            moments = batch_moments(minutes, minute_weights(minutes, end_time, decay))
+            new_minutes, stored_sketches, stored_covariance = minutes, None, None
+            new_from = start_time
+            aged = 1.0
+        else:
+            start_time, end_time = pd.Timestamp(moments['start_time'].min()), pd.Timestamp(moments['end_time'].max())
+            moments = moments[MOMENT_COLUMNS]
+            new_start, new_end = pd.Timestamp(self.baseline_start_time), pd.Timestamp(self.baseline_end_time)
+            
+            #Minutes can only be added at the front and removed at the back, a window moved back
+            #(or cut short) is rebuilt so the stored baseline always covers the configured window
+            if new_start < start_time or new_end < end_time:
+                self.logger.warning('Baseline window %s to %s moved back from %s to %s, rebuilding...'
+                                    % (new_start, new_end, start_time, end_time))
+                return self.update_baseline(rebuild=True)
+            
+            #Window hasn't moved, keep the stored tables (and the baseline cache) as they are
+            sketches_missing = stored_sketches is not None and len(stored_sketches) == 0
+            covariance_missing = stored_covariance is not None and len(stored_covariance) == 0
+            if new_end == end_time and new_start == start_time and not sketches_missing and not covariance_missing:
+                self.logger.debug('Baseline window unchanged, nothing to update...')
+                return None
+            
+            #Age old moments by the time the window moved forward, before new data is added
+            aged = 1.0
+            if decay < 1 and new_end > end_time:
+                aged = decay ** ((new_end - end_time) / pd.Timedelta(days=1))
+                moments = decay_moments(moments, aged)
+            
+            #Fold in new minutes at the front of the window
+            new_from = end_time
+            if new_end > end_time:
+                minutes = self.database_conn(query=3, time_range=(str(end_time), str(new_end)))
+                moments = merge_moments(moments, batch_moments(minutes, minute_weights(minutes, new_end, decay)))
+                end_time = new_end
+                new_minutes = minutes
+            
+            #Subtract minutes that fell off the back of the window, with the weight they have now
+            if new_start > start_time:
+                minutes = self.database_conn(query=3, time_range=(str(start_time), str(new_start)))
+                moments = merge_moments(moments, batch_moments(minutes, minute_weights(minutes, end_time, decay)), subtract=True)
+                start_time = new_start
+                old_minutes = minutes
+        
+        moments = moments.assign(start_time=start_time, end_time=end_time)
+        baseline = moments_to_baseline(moments)
+        
+        #Sketches are kept per partition, a missing sketch table is built again partition by partition
+        if self.use_sketches():
+            sketch_frame = self.update_sketches(stored_sketches, new_minutes, new_from)
+            self.database_conn(query=10, input_dataframe=sketch_frame)
+            if self.threshold_mode != 'zscore':
+                baseline = self.robust_baseline(quantile_sketch.frame_to_sketches(sketch_frame, self.sketch_compression), start_time, end_time)
+        
+        #A covariance table missing from a stored baseline is rebuilt over the whole window in one scan
+        rebuilt = {}
+        if self.scoring_mode == 'multivariate' and stored_covariance is not None and len(stored_covariance) == 0:
+            rebuilt = self.scan_baseline(['comoments'], decay)
+        
+        #Co-moments follow the moments
+        if self.scoring_mode == 'multivariate':
+            if stored_covariance is None:
+                comoments = batch_comoments(new_minutes, minute_weights(new_minutes, end_time, decay))
+            elif len(stored_covariance) == 0:
+                comoments = rebuilt['comoments']
+            else:
+                comoments = decay_moments(frame_to_comoments(stored_covariance), aged)
+                if new_minutes is not None:
+                    comoments = merge_comoments(comoments, batch_comoments(new_minutes, minute_weights(new_minutes, end_time, decay)))
+                if old_minutes is not None:
+                    comoments = merge_comoments(comoments, batch_comoments(old_minutes, minute_weights(old_minutes, end_time, decay)), subtract=True)
+            self.database_conn(query=12, input_dataframe=comoments_to_frame(comoments, start_time, end_time))
+        
+        self.database_conn(query=7, input_dataframe=(moments, baseline))
+        self.invalidate_baseline_cache()
+        return baseline
+        
+    def scoring_baseline(self, time_range=None):
+        '''
+        Baseline used for scoring: the stored table (baseline_source = table) or a rolling/EWMA
+        baseline from the in-memory window store (baseline_source = rolling or ewma).
+        '''
+        if self.baseline_source == 'table':
+            return self.get_baseline()
+        return self.get_window_store(time_range).baseline(self.baseline_source)
     
-                    self.logger.debug('Storing Baseline...')
-                    
-                    #Remove old baseline
-                    cur = conn.cursor()
-                    sql = """TRUNCATE public.stats_profile_baseline;"""
-                    cur.execute(sql)
-                    
-                    #Create method to insert pd dataframe directly into postgres
-                    def execute_values(conn, df, table): 
-  
-                        tuples = [tuple(x) for x in df.to_numpy()] 
-                      
-                        cols = ','.join(list(df.columns)) 
-                        # SQL query to execute 
-                        query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols) 
-                        cursor = conn.cursor() 
-                        try: 
-                            extras.execute_values(cursor, query, tuples) 
-                            conn.commit() 
-                        except (Exception, pg.DatabaseError) as error: 
-                            print("Error: %s" % error) 
-                            conn.rollback() 
-                            cursor.close() 
-                            return 1
-                        cursor.close() 
-                    
-                    #Call above function to insert baseline dataframe into baseline table in postgres
-                    execute_values(conn, input_dataframe, 'stats_profile_baseline')
-                    
-                    self.logger.debug('Stored Baseline Successfully...')
-                
-                #Query to get raw data. This is the sample data that is compared to the baseline
-                elif query==3:
-                
-                    #Attempt Initial Connection to database where raw data is stored
-                    conn = pg.connect(
-                        host=str(self.raw_db_address),
-                        database=self.raw_db_name,
-                        user=self.raw_db_username,
-                        password=self.raw_db_password)
-                    
+    def get_window_store(self, time_range=None):
+        '''
+        Window store of the last window_minutes minutes per robot, created on first use. It is
+        loaded from window_store_file if one was saved, otherwise warmed up with one query over
+        the window_minutes before the window about to be scored.
+        '''
+        if self.window_store is not None:
+            return self.window_store
+        store = window_store.window_store(self.window_minutes, self.window_dtype, self.ewma_alpha, self.window_min_minutes)
+        if self.window_store_file and os.path.exists(self.window_store_file) and store.load(self.window_store_file):
+            self.logger.debug('Loaded window store for %s robots...' % len(store.robot_names))
+        else:
+            start_time = pd.Timestamp(self.sample_start_time if time_range is None else time_range[0])
+            self.logger.debug('Warming up window store...')
+            store.add(self.database_conn(query=3, time_range=(str(start_time - pd.Timedelta(minutes=self.window_minutes)), str(start_time))))
+        self.window_store = store
+        return store
     
-                    self.logger.debug('Retrieving Raw Data...')
-                    #Open a cursor to perform database operations
-                    cur = conn.cursor()
-                    
-                    #Build Dynamic Query
-                    sql = """SELECT date_trunc('minute', "Time_Stamp") AS time_by_minute, "Robot_Name",
-                                ROUND(CAST(MAX("Amp_1") as numeric), 5) as max_amp_1, 
-                                ROUND(CAST(MAX("Amp_2") as numeric), 5) as max_amp_2, 
-                                ROUND(CAST(MAX("Amp_3") as numeric), 5) as max_amp_3, 
-                                ROUND(CAST(MAX("Amp_4") as numeric), 5) as max_amp_4, 
-                                ROUND(CAST(MAX("Amp_5") as numeric), 5) as max_amp_5, 
-                                ROUND(CAST(MAX("Amp_6") as numeric), 5) as max_amp_6
-                                FROM public.everything
-                                WHERE "Time_Stamp" > %(sample_start_time)s and "Time_Stamp" < %(sample_end_time)s
-                                GROUP  BY 1, "Robot_Name"
-                                ORDER BY time_by_minute ASC;
-                            """
-                    
-                    #Execute Query
-                    cur.execute(sql, {'sample_start_time':self.sample_start_time, 'sample_end_time':self.sample_end_time})
-                    
-                    #Get query Result regardless of query case
-                    #Get Column names from query
-                    colnames = [desc[0] for desc in cur.description]
-                    
-                    # Retrieve query results
-                    records = cur.fetchall()
-                    
-                    #Convert to Pandas Dataframe for Processing
-                    query_results = pd.DataFrame(data = records, columns = colnames) 
-
-                    return query_results
-                
-                #Query to retrieve processed baseline data
-                elif query==4:
-                
-                    #Attempt Initial Connection to database where raw data is stored
-                    conn = pg.connect(
-                        host=str(self.raw_db_address),
-                        database=self.raw_db_name,
-                        user=self.raw_db_username,
-                        password=self.raw_db_password)
-                    
+    def observe_minutes(self, minutes):
+        #Feed scored minutes to the window store and save it so a restart doesn't need a warm up
+        if self.baseline_source == 'table' or minutes is None or len(minutes) == 0:
+            return
+        store = self.get_window_store()
+        store.add(minutes)
+        if self.window_store_file:
+            store.save(self.window_store_file)
     
-                    self.logger.debug('Retrieving Baseline...')
-                    #Open a cursor to perform database operations
-                    cur = conn.cursor()
-                    
-                    #Build Dynamic Query
-                    sql = """SELECT * FROM public.stats_profile_baseline;
-                            """
-                    
-                    #Execute Query
-                    cur.execute(sql)
-                    
-                    #Get query Result regardless of query case
-                    #Get Column names from query
-                    colnames = [desc[0] for desc in cur.description]
-                    
-                    # Retrieve query results
-                    records = cur.fetchall()
-                    
-                    #Convert to Pandas Dataframe for Processing
-                    query_results = pd.DataFrame(data = records, columns = colnames) 
-
-                    return query_results
-                
-                #Case in which processed baseline needs to be stored to a database    
-                elif query==5:
-                    
-                    #Attempt Initial Connection to database where baseline is stored
-                    conn = pg.connect(
-                        host=str(self.processed_db_address),
-                        database=self.processed_db_name,
-                        user=self.processed_db_username,
-                        password=self.processed_db_password)
-                    
+    def get_baseline(self):
+        '''
+        Stored baseline for scoring. With scoring_mode = multivariate the mean vector and inverse
+        covariance of each robot are added as cov_mean_i and inv_cov_ij columns, re-read only when
+        the baseline table version changes (every call when the baseline cache is off). The
+        mean columns of the baseline itself hold medians or percentile midpoints in the robust
+        threshold modes, so the covariance keeps its own.
+        '''
+        baseline_dataframe = self.table_baseline()
+        if self.scoring_mode != 'multivariate':
+            return baseline_dataframe
+        version = None if self.cached_baseline is None else self.cached_baseline[0]['version']
+        if version is None or self.cached_covariance is None or self.cached_covariance[0] != version:
+            covariance = self.database_conn(query=13)
+            inverse = np.array([from_bytea(c, 36) for c in covariance['inv_covariance']]).reshape(-1, 36)
+            means = np.array([from_bytea(m, 6) for m in covariance['mean']]).reshape(-1, 6)
+            wide = pd.DataFrame(np.hstack([means, inverse]), columns=COV_MEAN_LIST + INV_COV_LIST)
+            wide.insert(0, 'robot_name', covariance['robot_name'].to_numpy())
+            self.cached_covariance = (version, wide)
+        return baseline_dataframe.merge(self.cached_covariance[1], on='robot_name', how='left')
     
-                    self.logger.debug('Storing Anomalies...')
-                    
-                    #Create method to insert pd dataframe directly into postgres
-                    def execute_values(conn, df, table): 
-  
-                        tuples = [tuple(x) for x in df.to_numpy()] 
-                      
-                        cols = ','.join(list(df.columns)) 
-                        # SQL query to execute 
-                        query = "INSERT INTO %s(%s) VALUES %%s" % (table, cols) 
-                        cursor = conn.cursor() 
-                        try: 
-                            extras.execute_values(cursor, query, tuples) 
-                            conn.commit() 
-                        except (Exception, pg.DatabaseError) as error: 
-                            print("Error: %s" % error) 
-                            conn.rollback() 
-                            cursor.close() 
-                            return 1
-                        cursor.close() 
-                    
-                    #Call above function to insert baseline dataframe into baseline table in postgres
-                    execute_values(conn, input_dataframe, 'detected_anomalies')
-                    
-                    self.logger.debug('Stored Anomalies Successfully...')
-            
-                #If everything goes well break this loop
-                break
+    def table_baseline(self):
+        '''
+        Baseline for scoring (same columns as query 4). With baseline_cache on, the baseline is
+        kept in memory and on disk (memory-mapped .npy of the mean/std columns plus a .json with
+        the robot names), keyed on the baseline start/end times and the table version (md5).
+        The table version is only re-checked every baseline_cache_ttl seconds (the time of the
+        last check is kept in memory, a cache loaded from disk is checked on first use), and if
+        the processed database can't be reached the cached baseline is used as is.
+        '''
+        if self.baseline_cache != 'True':
+            return self.database_conn(query=4)
         
-            except Exception as error:
+        key = [str(self.baseline_start_time), str(self.baseline_end_time)]
+        if self.cached_baseline is None or self.cached_baseline[0]['key'] != key:
+            self.cached_baseline = self.read_baseline_cache(key)
+        
+        #Re-check the table version once the ttl is up
+        if self.cached_baseline is not None:
+            meta, baseline_dataframe = self.cached_baseline
+            if time.time() - meta['checked'] <= self.baseline_cache_ttl:
+                return baseline_dataframe
+            try:
+                version = self.baseline_version()
+            except (Exception, pg.Error) as error:
+                self.logger.warning('Could not validate baseline cache, using cached baseline: %s' % error)
+                return baseline_dataframe
+            if version == meta['version']:
+                meta['checked'] = time.time()
+                return baseline_dataframe
+            self.logger.debug('Baseline table changed, refreshing cache...')
+        
+        #Cache miss, read the version before the baseline so a rewrite in between is caught by
+        #the next check instead of being cached under the new version
+        version = self.baseline_version()
+        baseline_dataframe = self.database_conn(query=4)
+        meta = {'key': key, 'version': version, 'checked': time.time()}
+        self.write_baseline_cache(meta, baseline_dataframe)
+        self.cached_baseline = (meta, baseline_dataframe)
+        return baseline_dataframe
+    
+    def baseline_version(self):
+        #Version (md5) of the stored baseline from the data source, used to validate the cache
+        return self.get_source().version()
+    
+    def read_baseline_cache(self, key):
+        #Load the on-disk cache if it was built for the same baseline window
+        try:
+            with open(self.baseline_cache_file + '.json', 'r') as meta_file:
+                meta = json.load(meta_file)
+            if meta['key'] != key:
+                return None
+            values = np.load(self.baseline_cache_file + '.npy', mmap_mode='r')
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+        baseline_dataframe = pd.DataFrame(values, columns=MEAN_LIST + STD_LIST)
+        baseline_dataframe.insert(0, 'robot_name', meta.pop('robot_names'))
+        meta['checked'] = 0
+        return meta, baseline_dataframe
+    
+    def write_baseline_cache(self, meta, baseline_dataframe):
+        #Write the matrix and metadata to temp files then rename, the .json goes last so it always matches the .npy
+        values = baseline_dataframe[MEAN_LIST + STD_LIST].to_numpy(dtype=np.float64)
+        meta = {'key': meta['key'], 'version': meta['version'], 'robot_names': [str(r) for r in baseline_dataframe['robot_name']]}
+        with open(self.baseline_cache_file + '.npy.tmp', 'wb') as values_file:
+            np.save(values_file, values)
+        os.replace(self.baseline_cache_file + '.npy.tmp', self.baseline_cache_file + '.npy')
+        with open(self.baseline_cache_file + '.json.tmp', 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(self.baseline_cache_file + '.json.tmp', self.baseline_cache_file + '.json')
+    
+    def invalidate_baseline_cache(self):
+        #Called whenever this program rewrites the baseline table
+        self.cached_baseline = None
+        self.cached_covariance = None
+        for suffix in ('.json', '.npy'):
+            if os.path.exists(self.baseline_cache_file + suffix):
+                os.remove(self.baseline_cache_file + suffix)
+    
+    def database_conn(self, query=1, input_dataframe=False, time_range=None, robot_names=None):
+        ''' 
+        This method handles all queries used in the program by passing them to the selected data source
+        (data_source = postgres or local, see get_source). Both answer the same query numbers.
+        time_range (start, end) overrides the sample window for query 3 and robot_names limits it to some robots.
+        ''' 
+        #Parameters are built here once so every source gets the same dict
+        if query in (1, 3):
+            params = self.query_params(query, time_range, robot_names)[1]
+        elif query in (8, 9):
+            params = {'start_time': time_range[0], 'end_time': time_range[1]}
+        else:
+            params = None
+        key_columns = ANOMALY_KEY_COLUMNS if query == 5 and self.anomaly_upsert == 'True' else None
+        return self.get_source().run(query, input_dataframe, params=params, key_columns=key_columns)
+    
+    def agg_columns(self):
+        #SQL aggregate of each raw Amp column for agg_type (max, min, mean or p95)
+        if self.agg_type not in AGG_SQL:
+            raise ValueError('agg_type must be one of %s, not %s' % (', '.join(AGG_SQL), self.agg_type))
+        return {'amp_%d' % i: AGG_SQL[self.agg_type].format(col='Amp_%d' % i) for i in range(1, 7)}
+    
+    def refresh_rollup(self, query, time_range=None):
+        '''
+        Make sure the rollup covers the window query 1 or 3 is about to read. Recorded chunks are
+        remembered in memory, so a window inside them costs nothing (see extend_rollup).
+        '''
+        if query == 1:
+            time_range = (self.baseline_start_time, self.baseline_end_time)
+        elif time_range is None:
+            time_range = (self.sample_start_time, self.sample_end_time)
+        start_time, end_time = pd.Timestamp(time_range[0]).floor('min'), pd.Timestamp(time_range[1]).ceil('min')
+        covered = self.rollup_covered.get(self.agg_type, set())
+        if all(chunk_start in covered for chunk_start, _ in time_chunks(start_time, end_time, self.rollup_chunk_minutes)):
+            return
+        self.database_conn(query=8, time_range=(start_time, end_time))
+    
+    def query_params(self, query, time_range=None, robot_names=None):
+        '''
+        SQL, parameters and database (raw/processed) for the fetch queries 1, 3 and 4.
+        robot_names limits query 3 to a group of robots (None is every robot).
+        '''
+        if query == 1:
+            sql = ROLLUP_BASELINE_SQL if self.use_rollup == 'True' else BASELINE_SQL.format(**self.agg_columns())
+            return sql, {'baseline_start_time':self.baseline_start_time, 'baseline_end_time':self.baseline_end_time, 
+                         'agg_type':self.agg_type}, 'raw'
+        elif query == 3:
+            if time_range is None:
+                time_range = (self.sample_start_time, self.sample_end_time)
+            sql = ROLLUP_SAMPLE_SQL if self.use_rollup == 'True' else SAMPLE_SQL.format(**self.agg_columns())
+            return sql, {'sample_start_time':time_range[0], 'sample_end_time':time_range[1], 'agg_type':self.agg_type,
+                         'robot_names':None if robot_names is None else list(robot_names)}, 'raw'
+        elif query == 4:
+            return STORED_BASELINE_SQL, None, 'processed'
+        raise ValueError('Query %s can not be streamed' % query)
+    
+    def stream_query(self, query=3, time_range=None):
+        '''
+        Generator version of queries 1, 3 and 4, yields the result in batches of fetch_size rows
+        so memory is bounded by fetch_size, not by the window (see the stream method of the sources).
+        '''
+        params = self.query_params(query, time_range)[1]
+        yield from self.get_source().stream(query, params, self.fetch_size)
+    
+    def bulk_write(self, cur, dataframe, table, key_columns=None):
+        '''
+        Stream a dataframe into a table with COPY FROM STDIN from an in-memory csv buffer, no
+        per-row tuples or INSERT statements. With key_columns the rows are copied into a temp
+        staging table first, rows in the target with the same keys are deleted and the staged
+        rows inserted, so re-scoring an overlapping window replaces anomalies instead of
+        duplicating them. The caller owns the transaction (commit/rollback).
+        '''
+        if len(dataframe) == 0:
+            return 0
+        started = time.perf_counter()
+        
+        #Empty fields are loaded as NULL (NaN, None, NaT)
+        buffer = io.StringIO()
+        dataframe.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        cols = ','.join(list(dataframe.columns))
+        
+        if key_columns is None:
+            cur.copy_expert("COPY %s(%s) FROM STDIN WITH (FORMAT csv)" % (table, cols), buffer)
+        else:
+            stage = table + '_stage'
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS %s (LIKE %s INCLUDING DEFAULTS) ON COMMIT DELETE ROWS;" % (stage, table))
+            cur.copy_expert("COPY %s(%s) FROM STDIN WITH (FORMAT csv)" % (stage, cols), buffer)
+            match = ' AND '.join('t.%s = s.%s' % (k, k) for k in key_columns)
+            cur.execute("DELETE FROM %s t USING %s s WHERE %s;" % (table, stage, match))
+            cur.execute("INSERT INTO %s(%s) SELECT %s FROM %s;" % (table, cols, cols, stage))
+            cur.execute("TRUNCATE %s;" % stage)
+        self.metrics.observe('write', started, rows=len(dataframe))
+        return len(dataframe)
+    
+    def get_source(self):
+        #Data source selected by data_source (postgres or local), created on first use
+        if self.data_source == 'local':
+            if not isinstance(self.source, data_sources.local_source) or self.source.data_dir != self.local_data_dir:
+                self.source = data_sources.local_source(self.local_data_dir, self.metrics)
+        elif self.data_source == 'postgres':
+            if not isinstance(self.source, postgres_source):
+                self.source = postgres_source(self)
+        else:
+            raise ValueError('data_source must be postgres or local, not %s' % self.data_source)
+        return self.source
+    
+    def get_connection(self, database='raw'):
+        '''
+        Borrow a connection from the pool for the raw or processed database. Pools are created on
+        first use and kept for the life of the object. Connections idle longer than
+        db_health_check seconds are checked with SELECT 1 and replaced if dead.
+        '''
+        if database not in self.pools:
+            with self.pool_lock:
                 
-                # Print Exception and wait 5 seconds to reconnect
-                self.logger.debug("An exception occurred:", type(error).__name__, "–", error)
-                time.sleep(5)
-                self.logger.debug("Reattempting postgres database connection...") 
+                #Checked again under the lock, another thread may have just created it
+                if database not in self.pools:
+                    prefix = database + '_db_'
+                    self.pools[database] = pg_pool.ThreadedConnectionPool(
+                        1, self.db_pool_max,
+                        host=str(getattr(self, prefix + 'address')),
+                        database=getattr(self, prefix + 'name'),
+                        user=getattr(self, prefix + 'username'),
+                        password=getattr(self, prefix + 'password'))
+        
+        started = time.perf_counter()
+        conn = self.pools[database].getconn()
+        self.borrowed[id(conn)] = database
+        self.metrics.observe('connect', started)
+        
+        #Health check, a closed or dead connection is swapped for a new one
+        if conn.closed or time.time() - self.last_used.get(id(conn), 0) > self.db_health_check:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT 1;')
+                conn.rollback()
+            except (Exception, pg.Error):
+                self.release_connection(conn, discard=True)
+                conn = self.pools[database].getconn()
+                self.borrowed[id(conn)] = database
+        return conn
+    
+    def release_connection(self, conn, discard=False):
+        '''
+        Return a borrowed connection to its pool. Open read transactions are rolled back so the
+        backend is not left idle in transaction. discard=True closes it instead.
+        '''
+        database = self.borrowed.pop(id(conn), None)
+        if database is None or database not in self.pools:
+            return
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except (Exception, pg.Error):
+                discard = True
+        self.last_used[id(conn)] = time.time()
+        self.pools[database].putconn(conn, close=discard or bool(conn.closed))
     
-    def data_processing(self):
+    def close_pools(self):
+        #Close every pooled connection, called when the program stops
+        with self.pool_lock:
+            for database, pool in self.pools.items():
+                self.logger.debug('Closing %s connection pool...' % database)
+                pool.closeall()
+            self.pools = {}
+        self.borrowed = {}
+        self.last_used = {}
+    
+    def data_processing(self, time_range=None):
         self.logger.debug('Processing data...')
         """
         This is to transform/scale data. This queries the raw data, aggregates, and uses the z-score
-        formula, (z = (x - mean) /std), to find anomalies.
+        formula, (z = (x - mean) /std), to find anomalies. time_range overrides the sample window.
         """
         try:
             #Query raw database, process data in postgres, and return results
             self.logger.debug('Retrieving Sample Data...')
-            sample_dataframe = self.database_conn(query=3)
+            sample_dataframe = self.database_conn(query=3, time_range=time_range)
             
             #Retrieve Baseline Dataframe (contains mean of max amps, std of max amps)
             self.logger.debug('Retrieving Baseline...')
-            baseline_dataframe = self.database_conn(query=4)
-            
-            #Anomaly Detection Procedure
-            #Get unique list of robots from baseline (this will only check robots that exist in baseline)
-            robot_list = baseline_dataframe['robot_name'].unique()
-            
-            #Create blank anomaly list to append to
-            anomaly_list =[]
-            #Create list for the name of each joint
-            joint_list = ['max_amp_1', 'max_amp_2', 'max_amp_3', 'max_amp_4', 'max_amp_5', 'max_amp_6']
-            
+            baseline_dataframe = self.scoring_baseline(time_range)
             
-            #Zscore calculation (this function is applied to each data point)
-            def z_score (value, mean, std):                
-                #zscore calc
-                anomaly_score = (value - mean) / std                
-                return round(anomaly_score, 5)
+            #Anomaly Detection Procedure (vectorized, see score_anomalies)
+            anomaly_dataframe = self.score_anomalies(sample_dataframe, baseline_dataframe)
             
-            #Loop over each robot for anomalies
-            for r in robot_list:
-                
-                #filter for a single robot at a time
-                single_robot_sample = sample_dataframe[sample_dataframe['Robot_Name'].str.contains(r)] 
-                single_robot_baseline = baseline_dataframe[baseline_dataframe['robot_name'].str.contains(r)]
-                
-            #Iterate over each joint
-                for j in joint_list:
-                    
-                    #Iterate over each value in each joint
-                    for ind, v in enumerate(single_robot_sample[j]):
-                        z = z_score(v, single_robot_baseline['mean_of_max_amp_01'].iloc[0], single_robot_baseline['mean_of_max_amp_01'].iloc[0])
-                        
-                        #set anomaly threshold
-                        if z > float(self.anomaly_threshold) or z < (-1 * float(self.anomaly_threshold)):
-                            #append list with anomalies including information about the anomaly
-                            anomaly_list.append([single_robot_sample['Robot_Name'].iloc[ind], j, single_robot_sample['time_by_minute'].iloc[ind],  z, single_robot_sample[j].iloc[ind]])
-                            
-            # Create the pandas DataFrame 
-            anomaly_dataframe = pd.DataFrame(anomaly_list, columns = ['robot_name', 'joint', 'time_stamp', 'zscore', 'actual_value']) 
+            #Rolling baselines learn from the window after it has been scored
+            self.observe_minutes(sample_dataframe)
             
             return anomaly_dataframe
                             
@@ -419,25 +1561,413 @@ class statistical_profiling():
                     
         except Exception as error:
             
-            # Print Exception and wait 5 seconds to reconnect
-            self.logger.debug("An exception occurred:", type(error).__name__, "–", error)
-            time.sleep(5)
-            self.logger.debug("Reattempting postgres database connection...") 
+            #database_conn already retried, report the failure so the window is not marked as scored
+            self.logger.error('Processing failed: %s – %s' % (type(error).__name__, error))
+            return None
+        
+    def score_anomalies(self, sample_dataframe, baseline_dataframe):
+        """
+        Score every sample minute against the baseline in one batch. The sample frame (query 3)
+        is joined to the baseline frame (query 4) once by robot, then all six joints are scored
+        together as numpy arrays, z = (x - mean) / std, and the threshold is applied as a mask.
+        Rows come back in the same order as the old loop (robot, joint, time).
+        With scoring_mode = multivariate the joints are scored together instead (score_multivariate).
+        """
+        if self.scoring_mode == 'multivariate':
+            return self.score_multivariate(sample_dataframe, baseline_dataframe)
+        started = time.perf_counter()
+        
+        #Only robots that exist in baseline are checked, keep baseline order for output
+        robot_list = pd.unique(baseline_dataframe['robot_name'])
+        robot_rank = pd.Series(np.arange(len(robot_list)), index=robot_list)
+        baseline = baseline_dataframe.drop_duplicates('robot_name')[['robot_name'] + MEAN_LIST + STD_LIST]
+        
+        #Join sample to baseline once (inner join drops robots with no baseline)
+        merged = sample_dataframe.merge(baseline, how='inner', left_on='Robot_Name', right_on='robot_name', sort=False)
+        if len(merged) == 0:
+            self.metrics.observe('score', started, rows=0)
+            return pd.DataFrame(columns=ANOMALY_COLUMNS)
+        
+        #Decimal results from postgres are converted once here, not per value
+        values = merged[JOINT_LIST].to_numpy(dtype=np.float64)
+        means = merged[MEAN_LIST].to_numpy(dtype=np.float64)
+        stds = merged[STD_LIST].to_numpy(dtype=np.float64)
+        
+        #A percentile baseline is stored in units of half the quantile range (|z| > 1 outside it),
+        #scaling by the threshold here puts the quantiles at the threshold without a rebuild
+        threshold = float(self.anomaly_threshold)
+        if self.threshold_mode == 'percentile' and self.baseline_source == 'table':
+            stds = stds / threshold
+        
+        #Zscore calculation for every robot/minute/joint at once
+        with np.errstate(divide='ignore', invalid='ignore'):
+            z = np.round((values - means) / stds, 5)
+        
+        #set anomaly threshold (std of zero or missing values are not scored)
+        mask = np.isfinite(z) & (np.abs(z) > threshold)
+        rows, cols = np.nonzero(mask)
+        
+        # Create the pandas DataFrame 
+        anomaly_dataframe = pd.DataFrame({'robot_name': merged['Robot_Name'].to_numpy()[rows],
+                                          'joint': np.asarray(JOINT_LIST, dtype=object)[cols],
+                                          'time_stamp': merged['time_by_minute'].to_numpy()[rows],
+                                          'zscore': z[rows, cols],
+                                          'actual_value': values[rows, cols]})
+        
+        #Order by robot (baseline order), then joint, then sample order
+        order = np.lexsort((rows, cols, robot_rank.reindex(anomaly_dataframe['robot_name']).to_numpy()))
+        self.metrics.observe('score', started, rows=len(merged))
+        return anomaly_dataframe.iloc[order].reset_index(drop=True)
+        
+    def score_multivariate(self, sample_dataframe, baseline_dataframe):
+        """
+        Cross-joint scoring. Every sample minute of every robot gets the Mahalanobis distance
+        D = sqrt(d' S^-1 d) of its six joint values from the robot's mean vector, using the mean
+        and inverse covariance get_baseline adds to the baseline. All minutes are done as one batch: the
+        inverse rows are gathered per minute and applied with six vectorized multiply-adds.
+        Minutes with D > mahalanobis_threshold are stored once, with zscore = D and joint and
+        actual_value of the joint that adds most to D^2. The default 4.74 is the 99.9% point of
+        D for six normal joints (chi-square with 6 degrees of freedom).
+        Rows are ordered by robot (baseline order), then sample order.
+        """
+        started = time.perf_counter()
+        if not set(COV_MEAN_LIST + INV_COV_LIST).issubset(baseline_dataframe.columns):
+            raise ValueError('scoring_mode = multivariate needs the stored baseline and covariance (baseline_source = table)')
+        
+        #Only robots that exist in baseline are checked
+        baseline = baseline_dataframe.drop_duplicates('robot_name').reset_index(drop=True)
+        codes = pd.Index(baseline['robot_name']).get_indexer(sample_dataframe['Robot_Name'])
+        scored = codes >= 0
+        codes = codes[scored]
+        if len(codes) == 0:
+            self.metrics.observe('score', started, rows=0)
+            return pd.DataFrame(columns=ANOMALY_COLUMNS)
+        
+        values = sample_dataframe[JOINT_LIST].to_numpy(dtype=np.float64)[scored]
+        means = baseline[COV_MEAN_LIST].to_numpy(dtype=np.float64)
+        inverse = baseline[INV_COV_LIST].to_numpy(dtype=np.float64).reshape(-1, 6, 6)
+        
+        #d' S^-1 d for all minutes at once, missing values or covariance give NaN and are not scored
+        d = values - means[codes]
+        weighted = np.zeros_like(d)
+        for j in range(6):
+            weighted += d[:, j:j + 1] * inverse[codes, j]
+        contribution = d * weighted
+        with np.errstate(invalid='ignore'):
+            distance = np.round(np.sqrt(np.maximum(contribution.sum(axis=1), 0.0)), 5)
+        rows = np.nonzero(np.isfinite(distance) & (distance > self.mahalanobis_threshold))[0]
+        cols = np.argmax(contribution[rows], axis=1)
+        
+        anomaly_dataframe = pd.DataFrame({'robot_name': sample_dataframe['Robot_Name'].to_numpy()[scored][rows],
+                                          'joint': np.asarray(JOINT_LIST, dtype=object)[cols],
+                                          'time_stamp': sample_dataframe['time_by_minute'].to_numpy()[scored][rows],
+                                          'zscore': distance[rows],
+                                          'actual_value': values[rows, cols]})
+        order = np.lexsort((rows, codes[rows]))
+        self.metrics.observe('score', started, rows=len(codes))
+        return anomaly_dataframe.iloc[order].reset_index(drop=True)
+        
+    def backfill(self, start_time, end_time, chunk_minutes=None, workers=None):
+        '''
+        Re-score history between start_time and end_time against the stored baseline table.
+        The range is split into chunk_minutes chunks that run in a process pool. Each chunk
+        replaces its own anomalies (delete + insert in one transaction), so running a chunk
+        twice is harmless. Finished chunks are recorded in backfill_checkpoint, and a rerun
+        with the same range, chunk size, threshold, agg_type, threshold/scoring mode and stored
+        baseline (its version) skips them, so an interrupted backfill resumes where it stopped. Returns the number of anomalies stored.
+        '''
+        self.get_parameters()
+        chunk_minutes = chunk_minutes or self.backfill_chunk_minutes
+        workers = workers or self.backfill_workers
+        start_time, end_time = pd.Timestamp(start_time).floor('min'), pd.Timestamp(end_time).ceil('min')
+        edges = list(pd.date_range(start_time, end_time, freq='%dmin' % chunk_minutes))
+        if edges[-1] < end_time:
+            edges.append(end_time)
+        chunks = [(str(s0), str(s1)) for s0, s1 in zip(edges[:-1], edges[1:])]
+        
+        #Checkpoint only applies to the same backfill settings and baseline, chunks scored against
+        #a baseline that has since been rebuilt are done again
+        key = [str(start_time), str(end_time), chunk_minutes, str(self.anomaly_threshold), self.agg_type,
+               self.threshold_mode, self.scoring_mode, self.baseline_version()]
+        completed = set()
+        try:
+            with open(self.backfill_checkpoint, 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint['key'] == key:
+                completed = set(checkpoint['completed'])
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+        todo = [(index, chunk) for index, chunk in enumerate(chunks) if chunk[0] not in completed]
+        self.logger.info('Backfill %s to %s: %s chunks, %s already done...' % (start_time, end_time, len(chunks), len(chunks) - len(todo)))
+        
+        stored = 0
+        try:
+            baseline_dataframe = self.get_baseline()
+            settings = self.worker_settings()
+            executor = self.get_executor(workers)
+            jobs = {executor.submit(backfill_chunk, index, chunk, baseline_dataframe, settings): chunk for index, chunk in todo}
+            for job in as_completed(jobs):
+                index, count = job.result()
+                stored += count
+                completed.add(jobs[job][0])
+                self.write_checkpoint({'key': key, 'completed': sorted(completed)})
+                self.metrics.count('backfill_chunks')
+                self.logger.info('Backfilled %s to %s (%s of %s chunks)...' % (jobs[job][0], jobs[job][1], len(completed), len(chunks)))
+        finally:
+            self.close_executor()
+            self.close_pools()
+        return stored
+    
+    def write_checkpoint(self, checkpoint):
+        #Temp file then rename so an interrupted run never leaves a broken checkpoint
+        with open(self.backfill_checkpoint + '.tmp', 'w') as checkpoint_file:
+            json.dump(checkpoint, checkpoint_file)
+        os.replace(self.backfill_checkpoint + '.tmp', self.backfill_checkpoint)
+    
+    def get_executor(self, workers):
+        '''
+        Process pool shared by parallel scoring, sketching and backfill. It lives until
+        close_executor (main's finally), so daemon cycles reuse the running workers and their
+        connection pools instead of spawning new processes every tick.
+        '''
+        if self.executor is not None and self.executor_workers != workers:
+            self.close_executor()
+        if self.executor is None:
+            #Spawn (not fork) so workers never share the parent's pooled sockets
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+            self.executor_workers = workers
+        return self.executor
+    
+    def close_executor(self):
+        #Stop the worker processes, called when the program stops
+        if self.executor is not None:
+            self.logger.debug('Stopping worker processes...')
+            self.executor.shutdown(cancel_futures=True)
+            self.executor = None
+            self.executor_workers = 0
+    
+    def worker_settings(self):
+        #Plain settings (everything get_parameters loads, plus changes made in memory) sent with each task
+        return {key: value for key, value in vars(self).items() if isinstance(value, (str, int, float))}
+    
+    def make_partitions(self, time_range, robot_list):
+        '''
+        Split the sample window into time_slices whole-minute slices and the robots into
+        robot_groups groups. Returns (index, time_range, robot_names) for every pair.
+        '''
+        start, end = pd.Timestamp(time_range[0]), pd.Timestamp(time_range[1])
+        edges = pd.date_range(start, end, periods=max(self.time_slices, 1) + 1).floor('min')
+        edges = [start] + sorted(set(e for e in edges if start < e < end)) + [end]
+        
+        robot_list = sorted(robot_list)
+        group_count = max(min(self.robot_groups, len(robot_list)), 1)
+        robot_groups = [robot_list[i::group_count] for i in range(group_count)]
+        
+        partitions = []
+        for s0, s1 in zip(edges[:-1], edges[1:]):
+            for group in robot_groups:
+                partitions.append((len(partitions), (str(s0), str(s1)), group))
+        return partitions
+    
+    def parallel_processing(self, time_range=None):
+        '''
+        Score the sample window in a process pool. Work is split by robot group and time slice,
+        each worker fetches and scores its own partition against the baseline rows of its robots,
+        and the results are merged here and sorted by robot, joint and time so the rows stored
+        are the same whatever order the workers finish in. Returns None if any partition fails.
+        '''
+        if time_range is None:
+            time_range = (self.sample_start_time, self.sample_end_time)
+        jobs = []
+        try:
+            self.logger.debug('Retrieving Baseline...')
+            baseline_dataframe = self.get_baseline()
+            
+            #Roll up the whole window once here rather than slice by slice in the workers
+            self.get_source().prepare(3, time_range)
+            partitions = self.make_partitions(time_range, pd.unique(baseline_dataframe['robot_name']))
+            self.logger.debug('Scoring %s partitions on %s workers...' % (len(partitions), self.workers))
+            
+            settings = self.worker_settings()
+            executor = self.get_executor(self.workers)
+            results = {}
+            jobs = [executor.submit(score_partition, index, partition_range, robot_names,
+                                    baseline_dataframe[baseline_dataframe['robot_name'].isin(robot_names)], settings)
+                    for index, partition_range, robot_names in partitions]
+            for job in as_completed(jobs):
+                index, anomalies = job.result()
+                results[index] = anomalies
+        except Exception as error:
+            self.logger.error('Parallel processing failed: %s – %s' % (type(error).__name__, error))
+            
+            #Drop partitions not started yet, a pool with a dead worker is replaced next cycle
+            for job in jobs:
+                job.cancel()
+            if isinstance(error, BrokenProcessPool):
+                self.close_executor()
+            return None
         
+        #Merge in partition order, then a stable sort gives a deterministic row order
+        merged = [results[index] for index in sorted(results) if len(results[index]) > 0]
+        if not merged:
+            return pd.DataFrame(columns=ANOMALY_COLUMNS)
+        anomaly_dataframe = pd.concat(merged, ignore_index=True)
+        return anomaly_dataframe.sort_values(['robot_name', 'joint', 'time_stamp'], kind='mergesort').reset_index(drop=True)
+    
+    def pipeline_processing(self, time_range=None):
+        '''
+        Concurrent version of a cycle. The baseline and the sample are fetched at the same time on
+        background threads, sample chunks (fetch_size rows, or the whole window when fetch_size
+        is 0) are scored as they arrive, and anomalies go through a bounded queue to a writer
+        thread that batches them into pipeline_write_batch row COPYs. Full queues block the stage
+        in front of them (backpressure), so memory stays bounded by the queue sizes.
+        Returns the number of anomalies stored, or None if any stage failed.
+        '''
+        sample_queue = queue.Queue(maxsize=self.pipeline_queue)
+        write_queue = queue.Queue(maxsize=self.pipeline_queue)
+        done = object()
+        errors = []
+        
+        def fetch_samples():
+            try:
+                if self.fetch_size > 0:
+                    for chunk in self.stream_query(query=3, time_range=time_range):
+                        sample_queue.put(chunk)
+                else:
+                    sample_queue.put(self.database_conn(query=3, time_range=time_range))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                sample_queue.put(done)
+        
+        def write_anomalies():
+            batch, rows = [], 0
+            while(True):
+                anomalies = write_queue.get()
+                if anomalies is not done:
+                    batch.append(anomalies)
+                    rows += len(anomalies)
+                if batch and (anomalies is done or rows >= self.pipeline_write_batch):
+                    try:
+                        if not errors:
+                            self.database_conn(query=5, input_dataframe=pd.concat(batch, ignore_index=True))
+                    except Exception as error:
+                        errors.append(error)
+                    batch, rows = [], 0
+                if anomalies is done:
+                    return
+        
+        stored = 0
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix='pipeline') as executor:
+            baseline_job = executor.submit(self.scoring_baseline, time_range)
+            executor.submit(fetch_samples)
+            writer_job = executor.submit(write_anomalies)
+            try:
+                baseline_dataframe = baseline_job.result()
+                while(True):
+                    chunk = sample_queue.get()
+                    if chunk is done:
+                        break
+                    if errors:
+                        continue
+                    anomalies = self.score_anomalies(chunk, baseline_dataframe)
+                    self.observe_minutes(chunk)
+                    if len(anomalies) > 0:
+                        write_queue.put(anomalies)
+                        stored += len(anomalies)
+            except Exception as error:
+                errors.append(error)
+                
+                #Drain the sample queue so the fetch thread can finish
+                while sample_queue.get() is not done:
+                    pass
+            finally:
+                write_queue.put(done)
+                writer_job.result()
+        
+        if errors:
+            self.logger.error('Pipeline failed: %s – %s' % (type(errors[0]).__name__, errors[0]))
+            return None
+        return stored
+    
+    def stream_anomalies(self, time_range=None):
+        '''
+        Streaming version of data_processing. The baseline is read once, then sample chunks from
+        stream_query are scored one at a time and the anomalies of each chunk are yielded.
+        '''
+        self.logger.debug('Retrieving Baseline...')
+        baseline_dataframe = self.scoring_baseline(time_range)
+        for sample_chunk in self.stream_query(query=3, time_range=time_range):
+            anomalies = self.score_anomalies(sample_chunk, baseline_dataframe)
+            self.observe_minutes(sample_chunk)
+            yield anomalies
+    
     def find_anomalies(self):
         self.logger.debug('Searching for anomalies...')
         
     def send_results(self):
         self.logger.debug('Sending results...')
         
+#Worker process state for parallel_processing, one object (and connection pool) per process
+_worker = None
+
+def get_worker(settings):
+    #Object for this worker process, created on the first task. Settings come from the parent with
+    #every task (not from config.txt), so workers always run with the parent's current values
+    #(log levels included)
+    global _worker
+    if _worker is None:
+        _worker = statistical_profiling(log_file=False)
+    _worker.__dict__.update(settings)
+    _worker.set_log_levels(_worker.console_log_level, _worker.file_log_level)
+    return _worker
+
+def score_partition(index, time_range, robot_names, baseline_dataframe, settings):
+    '''
+    Fetch and score one partition in a worker process. Returns (index, anomalies).
+    '''
+    worker = get_worker(settings)
+    sample_dataframe = worker.database_conn(query=3, time_range=time_range, robot_names=robot_names)
+    return index, worker.score_anomalies(sample_dataframe, baseline_dataframe)
+
+def backfill_chunk(index, time_range, baseline_dataframe, settings):
+    '''
+    Re-score one backfill chunk in a worker process and replace its anomalies.
+    Returns (index, anomalies stored).
+    '''
+    worker = get_worker(settings)
+    sample_dataframe = worker.database_conn(query=3, time_range=time_range)
+    anomalies = worker.score_anomalies(sample_dataframe, baseline_dataframe)
+    worker.database_conn(query=9, input_dataframe=anomalies, time_range=time_range)
+    return index, len(anomalies)
+
+def baseline_partition(index, time_range, parts, end_time, decay, settings):
+    '''
+    Fetch one partition of the baseline window in a worker process and reduce it to the
+    statistics in parts (see partition_stats). Returns (index, statistics).
+    '''
+    worker = get_worker(settings)
+    minutes = worker.database_conn(query=3, time_range=time_range)
+    return index, partition_stats(minutes, parts, worker.sketch_compression, end_time, decay)
+
 #Run Program if Main Program
 if __name__ == '__main__':
     
+    #Command line options, without any the program runs main() as configured in config.txt
+    parser = argparse.ArgumentParser(description='Statistical profiling anomaly detection')
+    parser.add_argument('--backfill', nargs=2, metavar=('START', 'END'), help='re-score history between START and END')
+    parser.add_argument('--chunk-minutes', type=int, help='backfill chunk size (default backfill_chunk_minutes)')
+    parser.add_argument('--workers', type=int, help='backfill worker processes (default backfill_workers)')
+    args = parser.parse_args()
+    
     #Create Object
     stat_profile = statistical_profiling()
     
-    #Run main
-    out = stat_profile.main()
+    #Run backfill or main
+    if args.backfill:
+        out = stat_profile.backfill(args.backfill[0], args.backfill[1], args.chunk_minutes, args.workers)
+    else:
+        out = stat_profile.main()
 
         
     
\ No newline at end of file
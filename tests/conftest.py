@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixture: a statistical_profiling object on the local data source with synthetic robot
+data, run from tmp_path so nothing is written to the repo.
+
+@author: bmkea
+"""
+import os
+import shutil
+import pytest
+import data_sources
+import statistical_profiling as sp
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def local_profile(tmp_path, monkeypatch):
+    #config.txt is read from the working directory, a copy in tmp_path keeps the run out of the repo
+    shutil.copy(os.path.join(REPO_DIR, 'config.txt'), tmp_path / 'config.txt')
+    monkeypatch.chdir(tmp_path)
+    raw = data_sources.synthetic_raw_data(robots=4, minutes=300, samples_per_minute=6, start_time='2024-01-01 00:00:00')
+    raw.to_csv(tmp_path / 'everything.csv', index=False)
+    profile = sp.statistical_profiling(log_file=False)
+    profile.get_parameters()
+    profile.data_source = 'local'
+    profile.local_data_dir = str(tmp_path)
+    profile.baseline_cache = 'False'
+    profile.baseline_cache_file = str(tmp_path / 'baseline_cache')
+    profile.use_rollup = 'False'
+    profile.agg_type = 'max'
+    profile.workers = 1
+    yield profile
+    profile.close_executor()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental baseline (baseline_mode = incremental) against a full rebuild of the same window,
+run on the local data source with synthetic robot data.
+
+@author: bmkea
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import statistical_profiling as sp
+
+
+@pytest.fixture
+def profile(local_profile):
+    #Synthetic data and local tables come from conftest.local_profile
+    local_profile.baseline_mode = 'incremental'
+    local_profile.threshold_mode = 'zscore'
+    local_profile.baseline_sketches = 'False'
+    local_profile.scoring_mode = 'multivariate'
+    return local_profile
+
+
+def set_window(profile, start, end):
+    profile.baseline_start_time = '2024-01-01 %s:00' % start
+    profile.baseline_end_time = '2024-01-01 %s:00' % end
+
+
+@pytest.mark.parametrize('decay', ['1', '0.01'])
+def test_incremental_matches_rebuild(profile, decay):
+    profile.baseline_decay = decay
+    set_window(profile, '00:00', '02:00')
+    profile.update_baseline(rebuild=True)
+    for start, end in (('00:30', '02:30'), ('01:00', '03:00'), ('01:00', '03:00'), ('01:45', '04:00')):
+        set_window(profile, start, end)
+        profile.update_baseline()
+    incremental = profile.database_conn(query=6)
+    incremental_covariance = sp.frame_to_comoments(profile.database_conn(query=13))
+
+    profile.update_baseline(rebuild=True)
+    rebuilt = profile.database_conn(query=6)
+    rebuilt_covariance = sp.frame_to_comoments(profile.database_conn(query=13))
+
+    assert len(incremental) == len(rebuilt) == 4 * 6
+    for column in ('n', 'mean', 'm2'):
+        np.testing.assert_allclose(incremental[column], rebuilt[column], rtol=1e-8)
+    for key in ('n', 'mean', 'comoment'):
+        np.testing.assert_allclose(incremental_covariance[key], rebuilt_covariance[key], rtol=1e-8, atol=1e-8)
+
+
+def test_unchanged_window_is_not_rewritten(profile):
+    profile.baseline_decay = '0.9'
+    set_window(profile, '00:00', '02:00')
+    profile.update_baseline(rebuild=True)
+    baseline = profile.database_conn(query=4)
+    for _ in range(30):
+        assert profile.update_baseline() is None
+    pd.testing.assert_frame_equal(profile.database_conn(query=4), baseline)
+
+
+@pytest.mark.parametrize('start, end', [('00:15', '02:00'), ('00:30', '01:30')])
+def test_window_moved_back_is_rebuilt(profile, start, end):
+    profile.baseline_decay = '1'
+    set_window(profile, '00:30', '02:00')
+    profile.update_baseline(rebuild=True)
+    set_window(profile, start, end)
+    assert profile.update_baseline() is not None
+    moved = profile.database_conn(query=6)
+
+    profile.update_baseline(rebuild=True)
+    np.testing.assert_allclose(moved['n'], profile.database_conn(query=6)['n'])
+    np.testing.assert_allclose(moved['mean'], profile.database_conn(query=6)['mean'], rtol=1e-8)
+
+
+def test_sketch_partitions_follow_window(profile):
+    #Sketches are stored per 30 minute partition, old partitions leave with the window
+    profile.scoring_mode = 'univariate'
+    profile.threshold_mode = 'mad'
+    profile.baseline_decay = '1'
+    profile.sketch_partition_minutes = 30
+    set_window(profile, '00:00', '02:00')
+    profile.update_baseline(rebuild=True)
+    for start, end in (('00:10', '02:20'), ('00:45', '03:00'), ('01:30', '04:05')):
+        set_window(profile, start, end)
+        profile.update_baseline()
+    incremental = profile.database_conn(query=11)
+    incremental_baseline = profile.database_conn(query=4)
+
+    profile.update_baseline(rebuild=True)
+    rebuilt = profile.database_conn(query=11)
+    rebuilt_baseline = profile.database_conn(query=4)
+
+    partitions = incremental.groupby('start_time')['end_time'].max()
+    assert list(partitions.index.astype(str)) == ['2024-01-01 01:30:00', '2024-01-01 02:00:00', '2024-01-01 02:30:00',
+                                                  '2024-01-01 03:00:00', '2024-01-01 03:30:00', '2024-01-01 04:00:00']
+    pd.testing.assert_series_equal(partitions, rebuilt.groupby('start_time')['end_time'].max())
+    np.testing.assert_allclose(incremental['n'], rebuilt['n'])
+    for column in sp.MEAN_LIST + sp.STD_LIST:
+        np.testing.assert_allclose(incremental_baseline[column], rebuilt_baseline[column], rtol=0.02)
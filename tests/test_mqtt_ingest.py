@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+MQTT ingestion through local_broker: raw samples published as messages must give the same
+anomalies as scoring query 3 over the same minutes, also when scoring fails for a step.
+
+@author: bmkea
+"""
+import json
+import time
+import pandas as pd
+import pytest
+import mqtt_ingest
+from schema import AMP_LIST
+
+WINDOW = ('2024-01-01 02:00:00', '2024-01-01 03:00:00')
+
+
+@pytest.fixture
+def profile(local_profile):
+    local_profile.baseline_mode = 'full'
+    local_profile.threshold_mode = 'zscore'
+    local_profile.baseline_sketches = 'False'
+    local_profile.scoring_mode = 'univariate'
+    local_profile.baseline_source = 'table'
+    local_profile.anomaly_threshold = '2'
+    local_profile.baseline_start_time = '2024-01-01 00:00:00'
+    local_profile.baseline_end_time = '2024-01-01 02:00:00'
+    local_profile.mqtt_topic = 'robots/#'
+    local_profile.mqtt_anomaly_topic = 'stats_profile/anomalies'
+    local_profile.mqtt_write = 'False'
+    local_profile.set_baseline()
+    return local_profile
+
+
+def publish_window(ingest, profile):
+    #Raw rows of the window, one message per sample in the public.everything layout
+    raw = profile.get_source().load_raw()
+    raw = raw[(raw['Time_Stamp'] >= WINDOW[0]) & (raw['Time_Stamp'] < WINDOW[1])]
+    for row in raw.itertuples(index=False):
+        sample = {'Time_Stamp': str(row.Time_Stamp), 'Robot_Name': row.Robot_Name}
+        sample.update({amp: getattr(row, amp) for amp in AMP_LIST})
+        ingest.client.publish('robots/%s' % row.Robot_Name, json.dumps(sample))
+
+
+def sort_anomalies(anomalies):
+    anomalies = anomalies.copy()
+    anomalies['time_stamp'] = pd.to_datetime(anomalies['time_stamp'])
+    return anomalies.sort_values(['robot_name', 'joint', 'time_stamp']).reset_index(drop=True)
+
+
+def test_ingest_matches_query(profile):
+    ingest = mqtt_ingest.mqtt_ingest(profile, client=mqtt_ingest.local_broker())
+    ingest.start()
+    publish_window(ingest, profile)
+
+    #Wall clock well past the last sample closes every minute
+    anomalies = ingest.step(now=time.time() + 3600)
+    expected = profile.score_anomalies(profile.database_conn(query=3, time_range=WINDOW), profile.get_baseline())
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(sort_anomalies(anomalies), sort_anomalies(expected), check_dtype=False)
+    published = [t for t, _ in ingest.client.published if t == profile.mqtt_anomaly_topic]
+    assert len(published) == len(expected)
+
+
+def test_failed_scoring_is_retried(profile, monkeypatch):
+    ingest = mqtt_ingest.mqtt_ingest(profile, client=mqtt_ingest.local_broker())
+    ingest.start()
+    publish_window(ingest, profile)
+
+    def unreachable():
+        raise ConnectionError('processed database unreachable')
+    monkeypatch.setattr(profile, 'scoring_baseline', unreachable)
+    assert len(ingest.step(now=time.time() + 3600)) == 0
+    monkeypatch.delattr(profile, 'scoring_baseline')
+
+    anomalies = ingest.step(now=time.time() + 3600)
+    expected = profile.score_anomalies(profile.database_conn(query=3, time_range=WINDOW), profile.get_baseline())
+    pd.testing.assert_frame_equal(sort_anomalies(anomalies), sort_anomalies(expected), check_dtype=False)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Quantile sketch accuracy against numpy on the same values: quantiles, MAD, merged sketches and
+the stored (per partition) form.
+
+@author: bmkea
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import quantile_sketch
+from schema import JOINT_LIST
+
+QUANTILES = [0.001, 0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99, 0.999]
+
+
+def sample_values(kind, size=20000, seed=3):
+    rng = np.random.default_rng(seed)
+    if kind == 'normal':
+        return rng.normal(10, 2, size)
+    #Skewed with a long upper tail, like amperage maxima with spikes
+    return rng.lognormal(1.5, 0.6, size)
+
+
+def rank_error(values, estimate, q):
+    #Error as a share of the values (rank), the way t-digest accuracy is stated
+    return abs(np.searchsorted(np.sort(values), estimate) / len(values) - q)
+
+
+def allowed_error(q):
+    #1% of the values in the middle, tightening towards the tails like the arcsine scale function
+    return 0.01 * min(1.0, 4 * q * (1 - q) + 0.05)
+
+
+@pytest.mark.parametrize('kind', ['normal', 'lognormal'])
+def test_quantiles_match_numpy(kind):
+    values = sample_values(kind)
+    sketch = quantile_sketch.quantile_sketch(100).add(values)
+    estimates = sketch.quantile(QUANTILES)
+    for q, estimate in zip(QUANTILES, estimates):
+        assert rank_error(values, estimate, q) <= allowed_error(q)
+    assert sketch.n == len(values)
+    assert sketch.quantile(0) == values.min() and sketch.quantile(1) == values.max()
+    assert len(sketch.means) <= 100
+
+
+@pytest.mark.parametrize('kind', ['normal', 'lognormal'])
+def test_mad_matches_numpy(kind):
+    values = sample_values(kind)
+    median = np.median(values)
+    expected = np.median(np.abs(values - median))
+    sketch = quantile_sketch.quantile_sketch(100).add(values)
+    assert sketch.mad() == pytest.approx(expected, rel=0.01)
+    assert sketch.quantile(0.5) == pytest.approx(median, rel=0.005)
+
+
+def test_merge_matches_numpy():
+    values = sample_values('lognormal')
+    merged = quantile_sketch.quantile_sketch(100)
+    for chunk in np.array_split(values, 7):
+        merged.merge(quantile_sketch.quantile_sketch(100).add(chunk))
+    estimates = merged.quantile(QUANTILES)
+    for q, estimate in zip(QUANTILES, estimates):
+        assert rank_error(values, estimate, q) <= allowed_error(q)
+    assert merged.n == len(values)
+    assert merged.mad() == pytest.approx(np.median(np.abs(values - np.median(values))), rel=0.01)
+
+
+def test_stored_partitions_merge():
+    #Three partitions of minutes for two robots, stored then read back and merged per robot/joint
+    rng = np.random.default_rng(4)
+    times = pd.date_range('2024-01-01', periods=600, freq='min')
+    minutes = pd.DataFrame(rng.normal(5, 1, size=(1200, 6)), columns=JOINT_LIST)
+    minutes.insert(0, 'Robot_Name', np.repeat(['Robot_01', 'Robot_02'], 600))
+    minutes.insert(0, 'time_by_minute', np.tile(times, 2))
+    edges = [times[0], times[200], times[400], times[-1] + pd.Timedelta(minutes=1)]
+    frame = pd.concat([quantile_sketch.sketches_to_frame(quantile_sketch.build_sketches(
+        minutes[(minutes['time_by_minute'] >= s) & (minutes['time_by_minute'] < e)]), s, e)
+        for s, e in zip(edges[:-1], edges[1:])], ignore_index=True)
+    assert len(frame) == 3 * 2 * 6
+
+    sketches = quantile_sketch.frame_to_sketches(frame)
+    assert len(sketches) == 2 * 6
+    for (robot_name, joint), sketch in sketches.items():
+        values = minutes.loc[minutes['Robot_Name'] == robot_name, joint].to_numpy()
+        assert sketch.n == len(values)
+        assert sketch.quantile(0.5) == pytest.approx(np.median(values), abs=0.02)
+
+
+def test_percentile_baseline_is_threshold_free():
+    values = sample_values('normal')
+    sketches = {('Robot_01', joint): quantile_sketch.quantile_sketch(100).add(values) for joint in JOINT_LIST}
+    baseline = quantile_sketch.sketch_baseline(sketches, 'percentile', 0.01, 0.99)
+    low, high = sketches[('Robot_01', JOINT_LIST[0])].quantile([0.01, 0.99])
+    assert baseline['mean_of_max_amp_01'].iloc[0] == (low + high) / 2
+    assert baseline['std_of_max_amp_01'].iloc[0] == (high - low) / 2
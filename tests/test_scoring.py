@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized zscore scoring (score_anomalies) against a per-value reference loop, the parallel,
+streaming and pipelined paths against the single batch, percentile scoring against the stored
+quantiles and multivariate scoring against numpy, on synthetic local data.
+
+@author: bmkea
+"""
+import configparser
+import numpy as np
+import pandas as pd
+import pytest
+import quantile_sketch
+import statistical_profiling as sp
+from schema import JOINT_LIST, MEAN_LIST, STD_LIST
+
+WINDOW = ('2024-01-01 02:00:00', '2024-01-01 03:00:00')
+
+
+@pytest.fixture
+def profile(local_profile):
+    local_profile.baseline_mode = 'full'
+    local_profile.threshold_mode = 'zscore'
+    local_profile.baseline_sketches = 'False'
+    local_profile.scoring_mode = 'univariate'
+    local_profile.baseline_source = 'table'
+    local_profile.anomaly_threshold = '2'
+    local_profile.baseline_start_time = '2024-01-01 00:00:00'
+    local_profile.baseline_end_time = '2024-01-01 02:00:00'
+    local_profile.sample_start_time, local_profile.sample_end_time = WINDOW
+    local_profile.set_baseline()
+    return local_profile
+
+
+def reference_anomalies(sample_dataframe, baseline_dataframe, threshold):
+    #One value at a time, in baseline robot order, then joint, then sample order
+    rows = []
+    for _, baseline in baseline_dataframe.iterrows():
+        robot_minutes = sample_dataframe[sample_dataframe['Robot_Name'] == baseline['robot_name']]
+        for joint, mean, std in zip(JOINT_LIST, MEAN_LIST, STD_LIST):
+            for _, minute in robot_minutes.iterrows():
+                z = round((minute[joint] - baseline[mean]) / baseline[std], 5)
+                if abs(z) > threshold:
+                    rows.append((baseline['robot_name'], joint, minute['time_by_minute'], z, minute[joint]))
+    return pd.DataFrame(rows, columns=sp.ANOMALY_COLUMNS)
+
+
+def sort_anomalies(anomalies):
+    anomalies = anomalies.copy()
+    anomalies['time_stamp'] = pd.to_datetime(anomalies['time_stamp'])
+    return anomalies.sort_values(['robot_name', 'joint', 'time_stamp']).reset_index(drop=True)[sp.ANOMALY_COLUMNS]
+
+
+def test_score_matches_reference(profile):
+    sample_dataframe = profile.database_conn(query=3, time_range=WINDOW)
+    baseline_dataframe = profile.get_baseline()
+    anomalies = profile.score_anomalies(sample_dataframe, baseline_dataframe)
+    expected = reference_anomalies(sample_dataframe, baseline_dataframe, 2.0)
+
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(anomalies, expected, check_dtype=False)
+
+
+def test_processing_paths_match(profile):
+    batch = sort_anomalies(profile.data_processing(time_range=WINDOW))
+
+    profile.fetch_size = 50
+    streamed = sort_anomalies(pd.concat(list(profile.stream_anomalies(time_range=WINDOW)), ignore_index=True))
+
+    profile.workers, profile.time_slices, profile.robot_groups = 2, 3, 2
+    parallel = sort_anomalies(profile.parallel_processing(time_range=WINDOW))
+
+    profile.workers, profile.pipeline = 1, 'True'
+    assert profile.pipeline_processing(time_range=WINDOW) == len(batch)
+    piped = sort_anomalies(profile.get_source().read_table('detected_anomalies'))
+
+    for other in (streamed, parallel, piped):
+        pd.testing.assert_frame_equal(other, batch, check_dtype=False)
+
+
+@pytest.mark.parametrize('threshold', ['1', '3'])
+def test_percentile_flags_values_outside_quantiles(profile, threshold):
+    #Baseline is built once, the threshold only changes the reported zscore
+    profile.threshold_mode, profile.percentile_low, profile.percentile_high = 'percentile', 0.05, 0.95
+    profile.set_baseline()
+    profile.anomaly_threshold = threshold
+    sample_dataframe = profile.database_conn(query=3, time_range=WINDOW)
+    baseline_dataframe = profile.get_baseline()
+    anomalies = profile.score_anomalies(sample_dataframe, baseline_dataframe)
+
+    sketches = quantile_sketch.frame_to_sketches(profile.database_conn(query=11))
+    expected = []
+    for _, minute in sample_dataframe.iterrows():
+        for joint in JOINT_LIST:
+            low, high = sketches[(minute['Robot_Name'], joint)].quantile([0.05, 0.95])
+            if minute[joint] < low or minute[joint] > high:
+                expected.append((minute['Robot_Name'], joint, minute['time_by_minute']))
+    assert len(expected) > 0
+    assert sorted(anomalies[['robot_name', 'joint', 'time_stamp']].itertuples(index=False, name=None)) == sorted(expected)
+
+
+def test_multivariate_matches_reference(profile):
+    #Robust threshold mode, so the baseline mean columns hold medians and the covariance mean is needed
+    profile.threshold_mode, profile.scoring_mode, profile.mahalanobis_threshold = 'mad', 'multivariate', 4.0
+    profile.set_baseline()
+    sample_dataframe = profile.database_conn(query=3, time_range=WINDOW)
+    anomalies = profile.score_multivariate(sample_dataframe, profile.get_baseline())
+
+    baseline_minutes = profile.database_conn(query=3, time_range=(profile.baseline_start_time, profile.baseline_end_time))
+    expected = []
+    for robot_name, minutes in sample_dataframe.groupby('Robot_Name'):
+        history = baseline_minutes.loc[baseline_minutes['Robot_Name'] == robot_name, JOINT_LIST].to_numpy()
+        inverse = np.linalg.inv(np.cov(history, rowvar=False))
+        d = minutes[JOINT_LIST].to_numpy() - history.mean(axis=0)
+        distance = np.sqrt(np.einsum('ij,jk,ik->i', d, inverse, d))
+        for time_stamp, value in zip(minutes['time_by_minute'], distance):
+            if value > 4.0:
+                expected.append((robot_name, time_stamp, value))
+    expected = pd.DataFrame(expected, columns=['robot_name', 'time_stamp', 'zscore'])
+
+    assert len(expected) > 0
+    found = sort_anomalies(anomalies).sort_values(['robot_name', 'time_stamp']).reset_index(drop=True)
+    expected = expected.sort_values(['robot_name', 'time_stamp']).reset_index(drop=True)
+    pd.testing.assert_frame_equal(found[['robot_name', 'time_stamp']],
+                                  expected[['robot_name', 'time_stamp']])
+    np.testing.assert_allclose(found['zscore'], expected['zscore'], atol=1e-4)
+
+
+def test_multivariate_needs_table_baseline(local_profile):
+    config = configparser.ConfigParser()
+    config.read('config.txt')
+    config['stats_config']['scoring_mode'] = 'multivariate'
+    config['stats_config']['baseline_source'] = 'rolling'
+    with open('config.txt', 'w') as config_file:
+        config.write(config_file)
+    with pytest.raises(ValueError, match='baseline_source = table'):
+        local_profile.get_parameters()
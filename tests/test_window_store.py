@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling and EWMA baselines of window_store against pandas rolling/ewm on the same minutes,
+with missing joint values and enough minutes for every ring to wrap several times.
+
+@author: bmkea
+"""
+import numpy as np
+import pandas as pd
+import pytest
+import window_store
+from schema import JOINT_LIST, MEAN_LIST, STD_LIST
+
+WINDOW, MIN_MINUTES, ALPHA = 25, 10, 0.2
+
+
+def minute_frame(robots=3, minutes=110, seed=1):
+    #Query 3 layout, about 10% missing values plus one joint missing for a whole stretch and
+    #one mostly missing in the last window (too few values for a std)
+    rng = np.random.default_rng(seed)
+    times = pd.date_range('2024-01-01 00:00:00', periods=minutes, freq='min')
+    frames = []
+    for r in range(robots):
+        values = rng.uniform(2, 20, size=6) + rng.standard_normal((minutes, 6))
+        values[rng.random((minutes, 6)) < 0.1] = np.nan
+        values[30:45, r] = np.nan
+        values[-20:, 5 - r] = np.nan
+        frame = pd.DataFrame(values, columns=JOINT_LIST)
+        frame.insert(0, 'Robot_Name', 'Robot_%02d' % r)
+        frame.insert(0, 'time_by_minute', times)
+        frames.append(frame)
+    return pd.concat(frames, ignore_index=True).sort_values(['time_by_minute', 'Robot_Name'], kind='mergesort')
+
+
+def pandas_baseline(minutes, kind):
+    rows = []
+    for robot, frame in minutes.groupby('Robot_Name', sort=False):
+        values = frame[JOINT_LIST].reset_index(drop=True)
+        if kind == 'ewma':
+            ewm = values.ewm(alpha=ALPHA, adjust=False, ignore_na=True)
+            mean, std = ewm.mean().iloc[-1], np.sqrt(ewm.var(bias=True).iloc[-1])
+        else:
+            mean = values.rolling(WINDOW, min_periods=1).mean().iloc[-1]
+            std = values.rolling(WINDOW, min_periods=1).std().iloc[-1]
+        count = values.iloc[-WINDOW:].notna().sum()
+        std = std.where(count >= MIN_MINUTES)
+        rows.append([robot] + list(mean) + list(std))
+    return pd.DataFrame(rows, columns=['robot_name'] + MEAN_LIST + STD_LIST)
+
+
+@pytest.mark.parametrize('kind', ['rolling', 'ewma'])
+@pytest.mark.parametrize('batch', [1, 7, 200])
+def test_matches_pandas(kind, batch):
+    minutes = minute_frame()
+    store = window_store.window_store(WINDOW, 'float64', ALPHA, MIN_MINUTES, capacity=2)
+    times = minutes['time_by_minute'].unique()
+    for start in range(0, len(times), batch):
+        store.add(minutes[minutes['time_by_minute'].isin(times[start:start + batch])])
+
+    #Adding minutes that are already stored changes nothing
+    store.add(minutes.iloc[-20:])
+    pd.testing.assert_frame_equal(store.baseline(kind), pandas_baseline(minutes, kind), rtol=1e-9)
+
+
+def test_save_and_load(tmp_path):
+    minutes = minute_frame()
+    store = window_store.window_store(WINDOW, 'float32', ALPHA, MIN_MINUTES)
+    store.add(minutes)
+    store.save(str(tmp_path / 'store.npz'))
+
+    loaded = window_store.window_store(WINDOW, 'float32', ALPHA, MIN_MINUTES)
+    assert loaded.load(str(tmp_path / 'store.npz'))
+    pd.testing.assert_frame_equal(loaded.baseline(), store.baseline())
+    assert not window_store.window_store(WINDOW + 1).load(str(tmp_path / 'store.npz'))
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory store of the last N minutes per robot and joint, used for rolling and adaptive
+(EWMA) baselines. Robot names are dictionary encoded to integer ids and the minute values live in
+one contiguous ring buffer, so memory per robot is fixed (window * 6 values plus a few running
+sums) and rolling mean/std/EWMA are updated in O(1) per minute without re-querying postgres.
+
+@author: bmkea
+"""
+import os
+import numpy as np
+import pandas as pd
+from schema import JOINT_LIST, MEAN_LIST, STD_LIST
+
+
+class window_store():
+    '''
+    Ring buffer of shape (robots, window, 6). Running sums and sums of squares give the rolling
+    mean/std, and an exponentially weighted mean/variance is kept next to them. Sums are
+    recomputed from the buffer every time a robot's ring wraps, so float error can't build up.
+    Missing values (NaN) are kept in the ring but left out of the sums, the EWMA and the per
+    joint counts, so a joint with gaps is not pulled towards 0.
+    '''
+
+    def __init__(self, window=60, dtype='float32', ewma_alpha=0.1, min_minutes=10, capacity=64):
+        self.window = int(window)
+        self.dtype = np.dtype(dtype)
+        self.ewma_alpha = float(ewma_alpha)
+        self.min_minutes = int(min_minutes)
+        self.robot_ids = {}
+        self.robot_names = []
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        #Grow every per-robot array to capacity robots, keeping what is stored
+        old = getattr(self, 'buffer', None)
+        size = 0 if old is None else len(old)
+
+        def grow(array, shape, dtype, fill=0):
+            new = np.full((capacity,) + shape, fill, dtype=dtype)
+            if array is not None:
+                new[:size] = array
+            return new
+
+        self.buffer = grow(old, (self.window, 6), self.dtype)
+        self.position = grow(getattr(self, 'position', None), (), np.int64)
+        self.count = grow(getattr(self, 'count', None), (), np.int64)
+        self.sums = grow(getattr(self, 'sums', None), (6,), np.float64)
+        self.sumsq = grow(getattr(self, 'sumsq', None), (6,), np.float64)
+        self.valid = grow(getattr(self, 'valid', None), (6,), np.int64)
+        self.ewma = grow(getattr(self, 'ewma', None), (6,), np.float64, np.nan)
+        self.ewmvar = grow(getattr(self, 'ewmvar', None), (6,), np.float64)
+        self.last_time = grow(getattr(self, 'last_time', None), (), 'datetime64[ns]', np.datetime64('NaT'))
+
+    def encode(self, robot_names):
+        #Map robot names to integer ids, new robots get the next id
+        ids = np.empty(len(robot_names), dtype=np.int64)
+        for i, name in enumerate(robot_names):
+            robot_id = self.robot_ids.get(name)
+            if robot_id is None:
+                robot_id = self.robot_ids[name] = len(self.robot_names)
+                self.robot_names.append(name)
+            ids[i] = robot_id
+        if len(self.robot_names) > len(self.buffer):
+            self.allocate(max(len(self.robot_names), 2 * len(self.buffer)))
+        return ids
+
+    def add(self, minutes):
+        '''
+        Add minutes in the query 3 layout (time_by_minute, Robot_Name, max_amp_1..6). Minutes at
+        or before a robot's last stored minute are skipped, so the same window can be added twice.
+        '''
+        if len(minutes) == 0:
+            return 0
+        minutes = minutes.sort_values('time_by_minute', kind='mergesort')
+        codes, uniques = pd.factorize(minutes['Robot_Name'])
+        ids = self.encode(list(uniques))[codes]
+        times = minutes['time_by_minute'].to_numpy(dtype='datetime64[ns]')
+        values = minutes[JOINT_LIST].to_numpy(dtype=np.float64)
+
+        #Rows are applied in rounds with at most one minute per robot, each round is vectorized
+        rounds = pd.Series(ids).groupby(ids).cumcount().to_numpy()
+        added = 0
+        for r in range(rounds.max() + 1):
+            rows = np.nonzero(rounds == r)[0]
+            robots, round_times, x = ids[rows], times[rows], values[rows]
+            fresh = np.isnat(self.last_time[robots]) | (round_times > self.last_time[robots])
+            robots, round_times, x = robots[fresh], round_times[fresh], x[fresh]
+            if len(robots) == 0:
+                continue
+            self.push(robots, x)
+            self.last_time[robots] = round_times
+            added += len(robots)
+        return added
+
+    def push(self, robots, x):
+        #O(1) update per robot: evict the oldest value once the ring is full, then add the new one
+        position = self.position[robots]
+        full = self.count[robots] >= self.window
+        evicted = np.where(full[:, None], self.buffer[robots, position].astype(np.float64), np.nan)
+        self.buffer[robots, position] = x
+        stored = self.buffer[robots, position].astype(np.float64)
+
+        #NaN joints add (or remove) nothing
+        present, gone = ~np.isnan(stored), ~np.isnan(evicted)
+        stored_0, evicted_0 = np.where(present, stored, 0.0), np.where(gone, evicted, 0.0)
+        self.sums[robots] += stored_0 - evicted_0
+        self.sumsq[robots] += stored_0 ** 2 - evicted_0 ** 2
+        self.valid[robots] += present.astype(np.int64) - gone.astype(np.int64)
+
+        #EWMA per joint, starts at the joint's first value and skips missing ones
+        ewma, ewmvar = self.ewma[robots], self.ewmvar[robots]
+        first = np.isnan(ewma)
+        delta = stored - ewma
+        ewma_next = np.where(first, stored, ewma + self.ewma_alpha * delta)
+        ewmvar_next = np.where(first, 0.0, (1 - self.ewma_alpha) * (ewmvar + self.ewma_alpha * delta ** 2))
+        self.ewma[robots] = np.where(present, ewma_next, ewma)
+        self.ewmvar[robots] = np.where(present, ewmvar_next, ewmvar)
+
+        self.count[robots] = np.minimum(self.count[robots] + 1, self.window)
+        self.position[robots] = (position + 1) % self.window
+
+        #Exact recompute when a ring wraps
+        wrapped = robots[self.position[robots] == 0]
+        if len(wrapped) > 0:
+            ring = self.buffer[wrapped].astype(np.float64)
+            self.sums[wrapped] = np.nansum(ring, axis=1)
+            self.sumsq[wrapped] = np.nansum(ring ** 2, axis=1)
+            self.valid[wrapped] = (~np.isnan(ring)).sum(axis=1)
+
+    def baseline(self, kind='rolling'):
+        '''
+        Baseline in the query 4 layout (robot_name, mean_of_max_amp_0n, std_of_max_amp_0n) from
+        the rolling window or the EWMA. Joints with fewer than min_minutes values in the window
+        get NaN std, so they are not scored until the window has warmed up.
+        '''
+        n = len(self.robot_names)
+        count = self.valid[:n].astype(np.float64)
+        if kind == 'ewma':
+            mean, std = self.ewma[:n], np.sqrt(self.ewmvar[:n])
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = self.sums[:n] / count
+                std = np.sqrt(np.maximum(self.sumsq[:n] - count * mean ** 2, 0.0) / (count - 1))
+        std = np.where(count >= max(self.min_minutes, 2), std, np.nan)
+        baseline = pd.DataFrame(np.hstack([mean, std]), columns=MEAN_LIST + STD_LIST)
+        baseline.insert(0, 'robot_name', self.robot_names)
+        return baseline
+
+    def memory_per_robot(self):
+        #Bytes per robot: ring buffer plus running state
+        return self.window * 6 * self.dtype.itemsize + 5 * 6 * 8 + 3 * 8
+
+    def save(self, path):
+        #Write to a temp file then rename, so a crash never leaves a half written store. Robot names
+        #are a plain str array, no pickled objects in the file
+        n = len(self.robot_names)
+        with open(path + '.tmp', 'wb') as store_file:
+            np.savez(store_file, robot_names=np.array([str(name) for name in self.robot_names], dtype=str),
+                     buffer=self.buffer[:n], position=self.position[:n], count=self.count[:n], sums=self.sums[:n],
+                     sumsq=self.sumsq[:n], valid=self.valid[:n], ewma=self.ewma[:n], ewmvar=self.ewmvar[:n],
+                     last_time=self.last_time[:n])
+        os.replace(path + '.tmp', path)
+
+    def load(self, path):
+        #Restore a saved store, only if it was saved with the same window length and layout
+        try:
+            saved = np.load(path)
+            if 'valid' not in saved.files or saved['buffer'].shape[1] != self.window:
+                return False
+            robot_names = [str(name) for name in saved['robot_names']]
+        except (OSError, ValueError):
+            return False
+        self.robot_names = robot_names
+        self.robot_ids = {name: i for i, name in enumerate(self.robot_names)}
+        self.buffer = self.position = self.count = self.sums = self.sumsq = self.valid = self.ewma = self.ewmvar = self.last_time = None
+        self.allocate(max(len(self.robot_names), 64))
+        n = len(self.robot_names)
+        self.buffer[:n] = saved['buffer']
+        for name in ('position', 'count', 'sums', 'sumsq', 'valid', 'ewma', 'ewmvar', 'last_time'):
+            getattr(self, name)[:n] = saved[name]
+        return True